@@ -4,23 +4,35 @@ Configurações centralizadas do projeto Skyfit Data Lake.
 Carrega variáveis de ambiente e fornece defaults seguros.
 """
 import os
+from functools import cached_property, lru_cache
 from pathlib import Path
-from dotenv import load_dotenv
+from typing import Dict
 
 # Determina o diretório raiz do projeto
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 CONFIG_DIR = PROJECT_ROOT / "config"
 LOGS_DIR = PROJECT_ROOT / "logs"
 
-# Carrega .env se existir
 env_file = CONFIG_DIR / ".env"
-if env_file.exists():
-    load_dotenv(env_file)
+
+
+@lru_cache(maxsize=None)
+def _env_snapshot() -> Dict[str, str]:
+    """
+    Carrega o .env (se existir) e retorna uma cópia única de os.environ.
+    
+    Executa apenas uma vez por processo. Com SKYFIT_SKIP_DOTENV=1 o .env
+    é ignorado (produção, onde o orquestrador já injeta as variáveis).
+    """
+    if os.environ.get("SKYFIT_SKIP_DOTENV") != "1" and env_file.is_file():
+        from dotenv import load_dotenv  # import tardio: só paga o custo se houver .env
+        load_dotenv(env_file)
+    return os.environ.copy()
 
 
 def get_env(name: str, default: str = None, required: bool = False) -> str:
     """Obtém variável de ambiente com validação."""
-    value = os.environ.get(name, "").strip()
+    value = _env_snapshot().get(name, "").strip()
     if not value:
         if required:
             raise RuntimeError(f"Variável de ambiente obrigatória não definida: {name}")
@@ -32,11 +44,12 @@ def get_env(name: str, default: str = None, required: bool = False) -> str:
 # AZURE STORAGE
 # =============================================================================
 class AzureStorageConfig:
-    ACCOUNT = get_env("AZURE_STORAGE_ACCOUNT", required=True)
-    KEY = get_env("AZURE_STORAGE_KEY", required=True)
-    CONTAINER = get_env("ADLS_CONTAINER", "datalake")
+    def __init__(self):
+        self.ACCOUNT = get_env("AZURE_STORAGE_ACCOUNT", required=True)
+        self.KEY = get_env("AZURE_STORAGE_KEY", required=True)
+        self.CONTAINER = get_env("ADLS_CONTAINER", "datalake")
     
-    @property
+    @cached_property
     def account_url(self) -> str:
         return f"https://{self.ACCOUNT}.blob.core.windows.net"
 
@@ -45,21 +58,22 @@ class AzureStorageConfig:
 # POSTGRESQL
 # =============================================================================
 class PostgresConfig:
-    HOST = get_env("PG_HOST", required=True)
-    PORT = int(get_env("PG_PORT", "5432"))
-    DATABASE = get_env("PG_DATABASE", "postgres")
-    USER = get_env("PG_USER", required=True)
-    PASSWORD = get_env("PG_PASSWORD", required=True)
-    SSLMODE = get_env("PG_SSLMODE", "require")
+    def __init__(self):
+        self.HOST = get_env("PG_HOST", required=True)
+        self.PORT = int(get_env("PG_PORT", "5432"))
+        self.DATABASE = get_env("PG_DATABASE", "postgres")
+        self.USER = get_env("PG_USER", required=True)
+        self.PASSWORD = get_env("PG_PASSWORD", required=True)
+        self.SSLMODE = get_env("PG_SSLMODE", "require")
     
-    @property
+    @cached_property
     def connection_string(self) -> str:
         return (
             f"host={self.HOST} port={self.PORT} dbname={self.DATABASE} "
             f"user={self.USER} password={self.PASSWORD} sslmode={self.SSLMODE}"
         )
     
-    @property
+    @cached_property
     def dsn(self) -> str:
         return (
             f"postgresql://{self.USER}:{self.PASSWORD}@{self.HOST}:{self.PORT}"
@@ -71,18 +85,18 @@ class PostgresConfig:
 # PIPEDRIVE
 # =============================================================================
 class PipedriveConfig:
-    COMPANY_DOMAIN = get_env("PIPEDRIVE_COMPANY_DOMAIN")
-    TOKEN_COMERCIAL = get_env("PIPEDRIVE_TOKEN_COMERCIAL")
-    TOKEN_EXPANSAO = get_env("PIPEDRIVE_TOKEN_EXPANSAO")
-    
     SCOPES = ["comercial", "expansao"]
     ENTITIES = ["deals", "persons", "organizations", "activities", "pipelines", "stages", "users"]
     
-    @classmethod
-    def get_token(cls, scope: str) -> str:
+    def __init__(self):
+        self.COMPANY_DOMAIN = get_env("PIPEDRIVE_COMPANY_DOMAIN")
+        self.TOKEN_COMERCIAL = get_env("PIPEDRIVE_TOKEN_COMERCIAL")
+        self.TOKEN_EXPANSAO = get_env("PIPEDRIVE_TOKEN_EXPANSAO")
+    
+    def get_token(self, scope: str) -> str:
         tokens = {
-            "comercial": cls.TOKEN_COMERCIAL,
-            "expansao": cls.TOKEN_EXPANSAO,
+            "comercial": self.TOKEN_COMERCIAL,
+            "expansao": self.TOKEN_EXPANSAO,
         }
         return tokens.get(scope)
 
@@ -91,27 +105,29 @@ class PipedriveConfig:
 # ZENDESK
 # =============================================================================
 class ZendeskConfig:
-    SUBDOMAIN = get_env("ZENDESK_SUBDOMAIN")
-    EMAIL = get_env("ZENDESK_EMAIL")
-    API_TOKEN = get_env("ZENDESK_API_TOKEN")
-    
     SCOPES = ["support"]
     ENTITIES = ["tickets", "users", "organizations", "groups", "ticket_fields", "ticket_forms"]
+    
+    def __init__(self):
+        self.SUBDOMAIN = get_env("ZENDESK_SUBDOMAIN")
+        self.EMAIL = get_env("ZENDESK_EMAIL")
+        self.API_TOKEN = get_env("ZENDESK_API_TOKEN")
 
 
 # =============================================================================
 # LOGGING
 # =============================================================================
 class LogConfig:
-    LEVEL = get_env("LOG_LEVEL", "INFO")
     DIR = LOGS_DIR
     
-    @classmethod
-    def ensure_dir(cls):
-        cls.DIR.mkdir(parents=True, exist_ok=True)
+    def __init__(self):
+        self.LEVEL = get_env("LOG_LEVEL", "INFO")
+    
+    def ensure_dir(self):
+        self.DIR.mkdir(parents=True, exist_ok=True)
 
 
-# Instâncias singleton para uso direto
+# Instâncias singleton para uso direto (valores lidos uma vez do snapshot do ambiente)
 azure_storage = AzureStorageConfig()
 postgres = PostgresConfig()
 pipedrive = PipedriveConfig()
@@ -4,40 +4,39 @@
 # Uso: python scripts/diagnose.py
 # ============================================================================
 
+import importlib
 import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-print("=" * 60)
-print("SKYFIT DATALAKE - DIAGNÓSTICO")
-print("=" * 60)
+# (módulo, atributo esperado) - importados em paralelo, reportados nesta ordem
+MODULES = [
+    ("config.settings", "postgres"),
+    ("src.common.lake", "LakeClient"),
+    ("src.common.logging_config", "RunLogger"),
+    ("src.loaders.load_pipedrive_stg", "PipedriveStgLoader"),
+    ("src.loaders.load_zendesk_stg", "ZendeskStgLoader"),
+    ("src.transformers.normalize_pipedrive", "PipedriveCoreNormalizer"),
+    ("src.transformers.normalize_zendesk", "ZendeskCoreNormalizer"),
+]
 
-# Test 1: Imports
-print("\n[1] Testando imports...")
-try:
-    from config.settings import azure_storage, postgres
-    print("    ✓ config.settings OK")
-except Exception as e:
-    print(f"    ✗ config.settings ERRO: {e}")
 
-try:
-    from src.common.lake import LakeClient
-    print("    ✓ src.common.lake OK")
-except Exception as e:
-    print(f"    ✗ src.common.lake ERRO: {e}")
-
-try:
-    from src.common.logging_config import RunLogger
-    print("    ✓ src.common.logging_config OK")
-except Exception as e:
-    print(f"    ✗ src.common.logging_config ERRO: {e}")
-
-# Test 2: PostgreSQL
-print("\n[2] Testando conexão PostgreSQL...")
-try:
+def import_probe(module: str, attr: str):
+    """Importa o módulo e valida o atributo esperado."""
+    mod = importlib.import_module(module)
+    return getattr(mod, attr)
+
+
+def pg_check():
+    """Conecta no PostgreSQL e retorna os schemas encontrados."""
     import psycopg2
+    from config.settings import postgres
+
     conn = psycopg2.connect(
         host=postgres.HOST,
         port=postgres.PORT,
@@ -46,70 +45,72 @@ try:
         password=postgres.PASSWORD,
         sslmode=postgres.SSLMODE
     )
-    cur = conn.cursor()
-    cur.execute("SELECT 1")
-    print("    ✓ PostgreSQL conectado!")
-    
-    # Verificar schemas
-    cur.execute("SELECT schema_name FROM information_schema.schemata WHERE schema_name IN ('stg_pipedrive', 'stg_zendesk', 'core')")
-    schemas = [r[0] for r in cur.fetchall()]
-    print(f"    ✓ Schemas encontrados: {schemas}")
-    
-    conn.close()
-except Exception as e:
-    print(f"    ✗ PostgreSQL ERRO: {e}")
-
-# Test 3: ADLS
-print("\n[3] Testando conexão ADLS...")
-try:
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+
+        # Verificar schemas
+        cur.execute("SELECT schema_name FROM information_schema.schemata WHERE schema_name IN ('stg_pipedrive', 'stg_zendesk', 'core')")
+        return [r[0] for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def adls_check():
+    """Conecta no ADLS e retorna quantos manifests foram listados."""
+    from config.settings import azure_storage
+    from src.common.lake import LakeClient
+
     lake = LakeClient(
         account=azure_storage.ACCOUNT,
         key=azure_storage.KEY,
         container=azure_storage.CONTAINER
     )
     # Listar manifests
-    manifests = list(lake.list_blobs("_meta/pipedrive/runs/"))[:3]
-    print(f"    ✓ ADLS conectado! Manifests: {len(manifests)}")
-except Exception as e:
-    print(f"    ✗ ADLS ERRO: {e}")
-
-# Test 4: Executar loaders manualmente
-print("\n[4] Testando load_pipedrive_stg...")
-try:
-    from src.loaders.load_pipedrive_stg import PipedriveStgLoader
-    print("    ✓ Import PipedriveStgLoader OK")
-except Exception as e:
-    print(f"    ✗ Import ERRO: {e}")
-    import traceback
-    traceback.print_exc()
-
-print("\n[5] Testando load_zendesk_stg...")
-try:
-    from src.loaders.load_zendesk_stg import ZendeskStgLoader
-    print("    ✓ Import ZendeskStgLoader OK")
-except Exception as e:
-    print(f"    ✗ Import ERRO: {e}")
-    import traceback
-    traceback.print_exc()
-
-print("\n[6] Testando normalize_pipedrive...")
-try:
-    from src.transformers.normalize_pipedrive import PipedriveCoreNormalizer
-    print("    ✓ Import PipedriveCoreNormalizer OK")
-except Exception as e:
-    print(f"    ✗ Import ERRO: {e}")
-    import traceback
-    traceback.print_exc()
-
-print("\n[7] Testando normalize_zendesk...")
-try:
-    from src.transformers.normalize_zendesk import ZendeskCoreNormalizer
-    print("    ✓ Import ZendeskCoreNormalizer OK")
-except Exception as e:
-    print(f"    ✗ Import ERRO: {e}")
-    import traceback
-    traceback.print_exc()
-
-print("\n" + "=" * 60)
-print("DIAGNÓSTICO COMPLETO")
-print("=" * 60)
+    manifests = list(islice(lake.list_blobs("_meta/pipedrive/runs/"), 3))
+    return len(manifests)
+
+
+def main():
+    print("=" * 60)
+    print("SKYFIT DATALAKE - DIAGNÓSTICO")
+    print("=" * 60)
+
+    with ThreadPoolExecutor(max_workers=len(MODULES)) as executor:
+        # Test 1: Imports (paralelos, impressos em ordem fixa)
+        print("\n[1] Testando imports...")
+        futures = [executor.submit(import_probe, module, attr) for module, attr in MODULES]
+        for (module, _), future in zip(MODULES, futures):
+            try:
+                future.result()
+                print(f"    ✓ {module} OK")
+            except Exception as e:
+                print(f"    ✗ {module} ERRO: {e}")
+                traceback.print_exception(type(e), e, e.__traceback__)
+
+        # Test 2 e 3: PostgreSQL e ADLS em paralelo
+        pg_future = executor.submit(pg_check)
+        adls_future = executor.submit(adls_check)
+
+        print("\n[2] Testando conexão PostgreSQL...")
+        try:
+            schemas = pg_future.result()
+            print("    ✓ PostgreSQL conectado!")
+            print(f"    ✓ Schemas encontrados: {schemas}")
+        except Exception as e:
+            print(f"    ✗ PostgreSQL ERRO: {e}")
+
+        print("\n[3] Testando conexão ADLS...")
+        try:
+            count = adls_future.result()
+            print(f"    ✓ ADLS conectado! Manifests: {count}")
+        except Exception as e:
+            print(f"    ✗ ADLS ERRO: {e}")
+
+    print("\n" + "=" * 60)
+    print("DIAGNÓSTICO COMPLETO")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,30 +16,31 @@ Uso:
     # REINDEX (reconstruir índices bloated)
     python sql/optimize_storage.py --reindex
     
+    # REINDEX com 3 índices em paralelo (padrão: 2)
+    python sql/optimize_storage.py --reindex --reindex-parallel 3
+    
     # Tudo junto (recomendado em janela de manutenção)
     python sql/optimize_storage.py --vacuum --reindex
 """
 import argparse
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 # Setup env
 def load_env():
-    env_paths = [
+    """Carrega o primeiro .env encontrado; dotenv só é importado se houver arquivo."""
+    for p in (
         Path(r"C:\skyfit-datalake\config\.env"),
         Path("config/.env"),
         Path(".env"),
-    ]
-    try:
-        from dotenv import load_dotenv
-        for p in env_paths:
-            if p.exists():
-                load_dotenv(p, override=True)
-                return True
-    except ImportError:
-        pass
+    ):
+        if p.is_file():
+            from dotenv import load_dotenv
+            load_dotenv(p, override=True)
+            return True
     return False
 
 load_env()
@@ -56,6 +57,12 @@ ENV = {
 }
 
 
+# Critérios para VACUUM: basta um deles para a tabela ser processada
+VACUUM_MIN_DEAD_TUPLES = 10000
+VACUUM_MIN_DEAD_RATIO = 0.05
+VACUUM_MAX_AGE_SECONDS = 7 * 86400
+
+
 def get_connection():
     return psycopg2.connect(
         host=ENV["PG_HOST"],
@@ -67,13 +74,18 @@ def get_connection():
     )
 
 
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+
 def format_bytes(size):
-    """Formata bytes para human readable."""
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if abs(size) < 1024.0:
-            return f"{size:.1f} {unit}"
-        size /= 1024.0
-    return f"{size:.1f} PB"
+    """Formata bytes para human readable (unidade escolhida por bit_length)."""
+    size = int(size)
+    if size < 0:
+        return "-" + format_bytes(-size)
+    if size == 0:
+        return "0.0 B"
+    i = min((size.bit_length() - 1) // 10, 5)
+    return f"{size / (1 << (10 * i)):.1f} {_UNITS[i]}"
 
 
 def analyze_tables(conn):
@@ -82,44 +94,115 @@ def analyze_tables(conn):
     print("📊 ANÁLISE DE ARMAZENAMENTO")
     print("="*80)
     
-    cur = conn.cursor()
+    # Cursor nomeado (server-side): as três análises vêm em um único
+    # round-trip e são consumidas em streaming, em blocos de itersize
+    cur = conn.cursor(name="analyze_cursor")
+    cur.itersize = 500
     
-    # Tamanho das tabelas
     cur.execute("""
-        SELECT 
-            schemaname || '.' || tablename AS tabela,
-            pg_total_relation_size(schemaname || '.' || tablename) AS total_bytes,
-            pg_relation_size(schemaname || '.' || tablename) AS data_bytes,
-            pg_total_relation_size(schemaname || '.' || tablename) - pg_relation_size(schemaname || '.' || tablename) AS index_bytes
-        FROM pg_tables 
-        WHERE schemaname IN ('stg_evo', 'core')
-        ORDER BY pg_total_relation_size(schemaname || '.' || tablename) DESC
+        WITH tables AS (
+            SELECT 
+                format('%I.%I', n.nspname, c.relname) AS name,
+                pg_total_relation_size(c.oid) AS total_bytes,
+                pg_relation_size(c.oid) AS data_bytes
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname IN ('stg_evo', 'core')
+              AND c.relkind IN ('r', 'p')
+        ),
+        dead AS (
+            SELECT 
+                format('%I.%I', schemaname, relname) AS name,
+                n_dead_tup,
+                n_live_tup
+            FROM pg_stat_user_tables
+            WHERE schemaname IN ('stg_evo', 'core')
+              AND n_dead_tup > 10000
+            ORDER BY n_dead_tup DESC
+            LIMIT 10
+        ),
+        unused AS (
+            SELECT 
+                format('%I.%I', n.nspname, s.relname) AS name,
+                c.relname AS indexname,
+                pg_relation_size(s.indexrelid) AS size
+            FROM pg_stat_user_indexes s
+            JOIN pg_class c ON c.oid = s.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname IN ('stg_evo', 'core')
+              AND s.idx_scan = 0
+              AND c.relname NOT LIKE '%\\_pkey'
+            ORDER BY size DESC
+            LIMIT 10
+        )
+        SELECT kind, name, m1, m2, extra FROM (
+            SELECT 1 AS ord, 'table' AS kind, name, total_bytes AS m1, data_bytes AS m2, NULL::text AS extra FROM tables
+            UNION ALL
+            SELECT 2, 'dead', name, n_dead_tup, n_live_tup, NULL FROM dead
+            UNION ALL
+            SELECT 3, 'unused', name, size, NULL, indexname::text FROM unused
+        ) r
+        ORDER BY ord, m1 DESC
     """)
     
-    tables = cur.fetchall()
     total_size = 0
     total_index = 0
     
-    print(f"\n{'Tabela':<40} {'Total':>12} {'Dados':>12} {'Índices':>12} {'% Índice':>10}")
-    print("-" * 86)
-    
     problematic = []
+    dead_tuples = []
+    unused_idx = []
+    rows = []  # Colunas já formatadas; impressas de uma vez ao final
     
-    for table, total, data, index in tables:
+    for kind, name, m1, m2, extra in cur:
+        if kind == "dead":
+            dead_tuples.append((name, m1, m2))
+            continue
+        if kind == "unused":
+            unused_idx.append((name, extra, m1))
+            continue
+        
+        table, total, data = name, m1, m2
+        index = total - data
         total_size += total
         total_index += index
         
         pct_index = (index / total * 100) if total > 0 else 0
         
         # Marca como problemático se índice > 50% do total
-        flag = "⚠️" if pct_index > 50 else ""
+        flag = ""
         if pct_index > 50:
+            flag = "⚠️"
             problematic.append((table, total, data, index, pct_index))
         
-        print(f"{table:<40} {format_bytes(total):>12} {format_bytes(data):>12} {format_bytes(index):>12} {pct_index:>8.1f}% {flag}")
+        rows.append((table, format_bytes(total), format_bytes(data),
+                     format_bytes(index), f"{pct_index:.1f}%", flag))
     
-    print("-" * 86)
-    print(f"{'TOTAL':<40} {format_bytes(total_size):>12} {format_bytes(total_size - total_index):>12} {format_bytes(total_index):>12}")
+    cur.close()
+    conn.rollback()  # Encerra a transação de leitura aberta pelo cursor nomeado
+    
+    header = ("Tabela", "Total", "Dados", "Índices", "% Índice")
+    # Larguras calculadas uma vez por coluna (mínimos = layout original)
+    w0, w1, w2, w3, w4 = (
+        max(minimum, *(len(r[i]) for r in rows)) if rows else minimum
+        for i, minimum in enumerate((40, 12, 12, 12, 10))
+    )
+    line = "-" * (w0 + w1 + w2 + w3 + w4 + 4)
+    
+    out = [
+        "",
+        f"{header[0]:<{w0}} {header[1]:>{w1}} {header[2]:>{w2}} {header[3]:>{w3}} {header[4]:>{w4}}",
+        line,
+    ]
+    out.extend(
+        f"{a:<{w0}} {b:>{w1}} {c:>{w2}} {d:>{w3}} {e:>{w4}} {f}"
+        for a, b, c, d, e, f in rows
+    )
+    out.append(line)
+    out.append(
+        f"{'TOTAL':<{w0}} {format_bytes(total_size):>{w1}} "
+        f"{format_bytes(total_size - total_index):>{w2}} {format_bytes(total_index):>{w3}}"
+    )
+    print("\n".join(out))
     
     # Diagnóstico
     print("\n" + "="*80)
@@ -137,59 +220,25 @@ def analyze_tables(conn):
         print("\n✅ Nenhuma tabela com índices excessivamente bloated")
     
     # Tuplas mortas
-    cur.execute("""
-        SELECT 
-            schemaname || '.' || relname AS tabela,
-            n_dead_tup,
-            n_live_tup,
-            last_vacuum,
-            last_autovacuum
-        FROM pg_stat_user_tables
-        WHERE schemaname IN ('stg_evo', 'core')
-          AND n_dead_tup > 10000
-        ORDER BY n_dead_tup DESC
-        LIMIT 10
-    """)
-    
-    dead_tuples = cur.fetchall()
-    
     if dead_tuples:
         print("\n⚠️ TABELAS COM MUITAS TUPLAS MORTAS (precisam de VACUUM):")
-        for table, dead, live, vac, autovac in dead_tuples:
+        for table, dead, live in dead_tuples:
             pct = (dead / (live + dead) * 100) if (live + dead) > 0 else 0
             print(f"  • {table}: {dead:,} mortas ({pct:.1f}%)")
     else:
         print("\n✅ Nenhuma tabela com excesso de tuplas mortas")
     
     # Índices não utilizados
-    cur.execute("""
-        SELECT 
-            schemaname || '.' || tablename AS tabela,
-            indexname,
-            pg_relation_size(indexrelid) AS size
-        FROM pg_stat_user_indexes
-        JOIN pg_indexes ON indexrelname = indexname
-        WHERE schemaname IN ('stg_evo', 'core')
-          AND idx_scan = 0
-          AND indexname NOT LIKE '%_pkey'
-        ORDER BY pg_relation_size(indexrelid) DESC
-        LIMIT 10
-    """)
-    
-    unused_idx = cur.fetchall()
-    
     if unused_idx:
         print("\n⚠️ ÍNDICES NUNCA UTILIZADOS (candidatos a remoção):")
         for table, idx, size in unused_idx:
             print(f"  • {idx} em {table}: {format_bytes(size)}")
     
-    cur.close()
-    
     return problematic
 
 
 def vacuum_tables(conn):
-    """Executa VACUUM ANALYZE nas tabelas principais."""
+    """Executa VACUUM ANALYZE nas tabelas principais que precisam."""
     print("\n" + "="*80)
     print("🧹 VACUUM ANALYZE")
     print("="*80)
@@ -207,14 +256,41 @@ def vacuum_tables(conn):
         'core.evo_prospects',
     ]
     
+    # Estatísticas atuais: só faz VACUUM onde há trabalho a fazer
+    cur = conn.cursor()
+    cur.execute("SHOW server_version_num")
+    server_version = int(cur.fetchone()[0])
+    cur.execute("""
+        SELECT 
+            format('%I.%I', schemaname, relname) AS tabela,
+            n_dead_tup,
+            n_live_tup,
+            extract(epoch FROM now() - coalesce(greatest(last_vacuum, last_autovacuum), 'epoch'::timestamptz))
+        FROM pg_stat_user_tables
+        WHERE schemaname IN ('stg_evo', 'core')
+    """)
+    stats = {table: (dead, live, age) for table, dead, live, age in cur.fetchall()}
+    cur.close()
+    conn.rollback()  # Encerra a transação de leitura antes do autocommit
+    
+    # PARALLEL (vacuum de índices em paralelo) existe a partir do PG 13
+    vacuum_cmd = "VACUUM (ANALYZE, PARALLEL 4)" if server_version >= 130000 else "VACUUM (ANALYZE)"
+    
     conn.autocommit = True  # VACUUM precisa de autocommit
     cur = conn.cursor()
     
     for table in tables:
+        if table in stats:
+            dead, live, age = stats[table]
+            dead_ratio = dead / (live + dead) if (live + dead) > 0 else 0
+            if dead <= VACUUM_MIN_DEAD_TUPLES and dead_ratio <= VACUUM_MIN_DEAD_RATIO and age <= VACUUM_MAX_AGE_SECONDS:
+                print(f"\n  Pulando {table} ({dead:,} mortas, {dead_ratio:.1%})")
+                continue
+        
         try:
             print(f"\n  Processando {table}...", end=" ", flush=True)
             start = datetime.now()
-            cur.execute(f"VACUUM (ANALYZE) {table}")
+            cur.execute(f"{vacuum_cmd} {table}")
             elapsed = (datetime.now() - start).total_seconds()
             print(f"✅ ({elapsed:.1f}s)")
         except Exception as e:
@@ -224,8 +300,22 @@ def vacuum_tables(conn):
     conn.autocommit = False
 
 
-def reindex_tables(conn):
-    """Reconstrói índices das tabelas principais."""
+def _reindex_one(schema, idx):
+    """Reconstrói um índice em conexão própria (autocommit). Retorna segundos."""
+    conn = get_connection()
+    conn.autocommit = True  # REINDEX CONCURRENTLY precisa de autocommit
+    try:
+        cur = conn.cursor()
+        start = datetime.now()
+        cur.execute(f'REINDEX INDEX CONCURRENTLY "{schema}"."{idx}"')
+        cur.close()
+        return (datetime.now() - start).total_seconds()
+    finally:
+        conn.close()
+
+
+def reindex_tables(conn, parallel=2):
+    """Reconstrói índices das tabelas principais (até `parallel` em paralelo)."""
     print("\n" + "="*80)
     print("🔧 REINDEX (CONCURRENTLY)")
     print("="*80)
@@ -235,38 +325,39 @@ def reindex_tables(conn):
     cur = conn.cursor()
     cur.execute("""
         SELECT 
-            schemaname,
-            tablename,
-            indexname,
-            pg_relation_size(indexrelid) AS size
-        FROM pg_stat_user_indexes
-        JOIN pg_indexes ON indexrelname = indexname
-        WHERE schemaname IN ('stg_evo', 'core')
-        ORDER BY pg_relation_size(indexrelid) DESC
+            n.nspname,
+            s.relname,
+            c.relname,
+            pg_relation_size(s.indexrelid) AS size
+        FROM pg_stat_user_indexes s
+        JOIN pg_class c ON c.oid = s.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname IN ('stg_evo', 'core')
+        ORDER BY size DESC
         LIMIT 20
     """)
     
     indexes = cur.fetchall()
     cur.close()
+    conn.rollback()  # Encerra a transação de leitura
     
-    conn.autocommit = True  # REINDEX CONCURRENTLY precisa de autocommit
-    cur = conn.cursor()
+    # Pula índices < 100MB
+    indexes = [(schema, idx, size) for schema, _, idx, size in indexes if size >= 100 * 1024 * 1024]
     
-    for schema, table, idx, size in indexes:
-        if size < 100 * 1024 * 1024:  # Pula índices < 100MB
-            continue
+    # Cada worker usa sua própria conexão; concorrência baixa para não pressionar o WAL
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = {}
+        for schema, idx, size in indexes:
+            print(f"\n  Reconstruindo {idx} ({format_bytes(size)})...", flush=True)
+            futures[executor.submit(_reindex_one, schema, idx)] = idx
         
-        try:
-            print(f"\n  Reconstruindo {idx} ({format_bytes(size)})...", end=" ", flush=True)
-            start = datetime.now()
-            cur.execute(f"REINDEX INDEX CONCURRENTLY {schema}.{idx}")
-            elapsed = (datetime.now() - start).total_seconds()
-            print(f"✅ ({elapsed:.1f}s)")
-        except Exception as e:
-            print(f"❌ Erro: {e}")
-    
-    cur.close()
-    conn.autocommit = False
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                elapsed = future.result()
+                print(f"  ✅ {idx} ({elapsed:.1f}s)")
+            except Exception as e:
+                print(f"  ❌ {idx} Erro: {e}")
 
 
 def show_recommendations(problematic):
@@ -313,6 +404,7 @@ def main():
     parser.add_argument("--analyze", action="store_true", help="Apenas análise (não modifica)")
     parser.add_argument("--vacuum", action="store_true", help="Executa VACUUM ANALYZE")
     parser.add_argument("--reindex", action="store_true", help="Reconstrói índices bloated")
+    parser.add_argument("--reindex-parallel", type=int, default=2, help="REINDEX simultâneos (padrão: 2)")
     args = parser.parse_args()
     
     # Se nenhuma flag, faz apenas análise
@@ -335,7 +427,7 @@ def main():
             vacuum_tables(conn)
         
         if args.reindex:
-            reindex_tables(conn)
+            reindex_tables(conn, parallel=args.reindex_parallel)
         
         # Mostra tamanho após otimizações
         if args.vacuum or args.reindex:
@@ -3,13 +3,14 @@
 Módulos utilitários compartilhados.
 """
 from .lake import LakeClient, create_lake_client
-from .db import DatabaseClient, create_db_client
+from .db import AsyncDatabaseClient, DatabaseClient, create_db_client
 from .logging_config import setup_logger, RunLogger
 
 __all__ = [
     "LakeClient",
     "create_lake_client",
     "DatabaseClient",
+    "AsyncDatabaseClient",
     "create_db_client",
     "setup_logger",
     "RunLogger",
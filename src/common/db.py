@@ -2,25 +2,100 @@
 """
 Utilitários para operações no PostgreSQL.
 """
+import asyncio
+import hashlib
+import io
 import json
+import sys
+import weakref
 from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Iterator
-import psycopg2
-from psycopg2.extras import execute_values, Json
+from uuid import uuid4
+
+try:
+    import orjson
+except ImportError:  # orjson é opcional; sem ele usa-se o json da stdlib
+    orjson = None
+
+# Raiz do projeto (para importar config.settings), resolvida uma única vez
+_PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
+
+
+class FastJson:
+    """
+    Adaptador psycopg2 para JSONB serializado com orjson.
+    
+    Serializa uma única vez no construtor e entrega o literal já
+    quotado, sem passar pelo json.dumps do psycopg2.extras.Json.
+    """
+    __slots__ = ("_bytes",)
+    
+    def __init__(self, obj: Any):
+        self._bytes = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    
+    def __conform__(self, proto):
+        return self
+    
+    def getquoted(self) -> bytes:
+        return b"'" + self._bytes.replace(b"'", b"''") + b"'::jsonb"
+
+
+# Encoder compacto compartilhado (fallback sem orjson): evita um JSONEncoder por registro
+_ENCODE = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+
+@lru_cache(maxsize=None)
+def _json_adapter():
+    """Retorna o adaptador JSONB: FastJson (orjson) ou Json com encoder compartilhado."""
+    if orjson is not None:
+        return FastJson
+    
+    from psycopg2.extras import Json
+    
+    class _CompactJson(Json):
+        def dumps(self, obj):
+            return _ENCODE(obj)
+    
+    return _CompactJson
+
+
+def _dumps_json(obj: Any) -> str:
+    """Serializa para texto JSON (orjson quando disponível)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return _ENCODE(obj)
+
+
+def _copy_text(value: Any) -> str:
+    """Formata um valor para o formato text do COPY (escapa separadores, NULL = \\N)."""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
 
 
 class DatabaseClient:
     """Cliente unificado para operações no PostgreSQL."""
     
+    # Acima deste volume bulk_insert_jsonb(use_copy=True) usa COPY em vez de INSERT multi-row
+    COPY_THRESHOLD = 10_000
+    
     def __init__(self, host: str, port: int, database: str, 
-                 user: str, password: str, sslmode: str = "require"):
+                 user: str, password: str, sslmode: str = "require",
+                 pool_size: int = 5):
         self.host = host
         self.port = port
         self.database = database
         self.user = user
         self.password = password
         self.sslmode = sslmode
+        self.pool_size = pool_size
         self._conn = None
+        self._pool = None
+        # Statements preparados vivem na sessão: cache por conexão (conn -> nomes)
+        self._prepared = weakref.WeakKeyDictionary()
     
     @property
     def connection_params(self) -> Dict[str, Any]:
@@ -34,45 +109,74 @@ class DatabaseClient:
         }
     
     def connect(self):
-        """Estabelece conexão com o banco."""
+        """Estabelece conexão com o banco (dedicada, fora do pool)."""
         if self._conn is None or self._conn.closed:
+            # import tardio: CLIs que só leem config não carregam o driver
+            import psycopg2
             self._conn = psycopg2.connect(**self.connection_params)
         return self._conn
     
+    def pool(self):
+        """
+        Inicializa (uma vez) o pool de conexões usado pelos helpers do cliente.
+        
+        O pool é thread-safe e abre até pool_size conexões. Ele não
+        bloqueia quando esgotado: threads além de pool_size recebem
+        PoolError, então dimensione pool_size >= concorrência máxima.
+        """
+        if self._pool is None or self._pool.closed:
+            from psycopg2.pool import ThreadedConnectionPool
+            self._pool = ThreadedConnectionPool(1, self.pool_size, **self.connection_params)
+        return self._pool
+    
     def close(self):
-        """Fecha a conexão."""
+        """Fecha a conexão dedicada e todas as conexões do pool."""
         if self._conn and not self._conn.closed:
             self._conn.close()
             self._conn = None
+        if self._pool and not self._pool.closed:
+            self._pool.closeall()
+            self._pool = None
+        self._prepared.clear()
     
     @contextmanager
-    def cursor(self, commit: bool = True):
-        """Context manager para cursor com auto-commit opcional."""
-        conn = self.connect()
-        cur = conn.cursor()
+    def connection(self):
+        """Context manager que empresta uma conexão do pool."""
+        pool = self.pool()
+        conn = pool.getconn()
         try:
-            yield cur
-            if commit:
-                conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
+            yield conn
         finally:
-            cur.close()
+            pool.putconn(conn)
+    
+    @contextmanager
+    def cursor(self, commit: bool = True):
+        """Context manager para cursor com auto-commit opcional."""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                if commit:
+                    conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
     
     @contextmanager
     def transaction(self):
         """Context manager para transação explícita."""
-        conn = self.connect()
-        cur = conn.cursor()
-        try:
-            yield cur
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            cur.close()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
     
     def execute(self, sql: str, params: Tuple = None) -> None:
         """Executa SQL sem retorno."""
@@ -97,6 +201,22 @@ class DatabaseClient:
             cur.execute(sql, params)
             return cur.fetchall()
     
+    def iter_rows(self, sql: str, params: Tuple = None,
+                  arraysize: int = 1000) -> Iterator[Tuple]:
+        """
+        Itera o resultado via cursor nomeado (server-side), em blocos de arraysize.
+        
+        Memória limitada e primeiras linhas disponíveis antes do fim da query.
+        Cursores nomeados exigem transação aberta (sem autocommit), por isso
+        a conexão fica emprestada do pool até o fim da iteração.
+        """
+        with self.connection() as conn:
+            with conn.cursor(name=f"it_{uuid4().hex}") as cur:
+                cur.itersize = arraysize
+                cur.execute(sql, params)
+                yield from cur
+            conn.rollback()  # Encerra a transação de leitura
+    
     def fetch_scalar(self, sql: str, params: Tuple = None) -> Any:
         """Executa SQL e retorna valor escalar."""
         row = self.fetch_one(sql, params)
@@ -117,10 +237,32 @@ class DatabaseClient:
         sql = f'SELECT COUNT(*) FROM "{schema}"."{table}"'
         return self.fetch_scalar(sql) or 0
     
+    def _execute_prepared(self, cur, sql: str, rows: Iterator[Tuple],
+                          num_params: int, page_size: int) -> None:
+        """
+        Executa um INSERT por linha via statement preparado.
+        
+        O PREPARE é feito uma única vez por conexão (nome derivado do SQL);
+        as linhas seguem como EXECUTE agrupados por execute_batch, um
+        round-trip por página sem re-parse/plan no servidor.
+        """
+        from psycopg2.extras import execute_batch
+        
+        name = "stmt_" + hashlib.blake2s(sql.encode("utf-8"), digest_size=6).hexdigest()
+        prepared = self._prepared.setdefault(cur.connection, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {sql}")
+            prepared.add(name)
+        
+        placeholders = ", ".join(["%s"] * num_params)
+        execute_batch(cur, f"EXECUTE {name} ({placeholders})", rows, page_size=page_size)
+    
     def bulk_insert_jsonb(self, schema: str, table: str, 
                           records: List[Dict[str, Any]],
                           extra_columns: Dict[str, Any] = None,
-                          batch_size: int = 1000) -> int:
+                          batch_size: int = 1000,
+                          prepared: bool = False,
+                          use_copy: bool = False) -> int:
         """
         Insere registros em massa em tabela com coluna JSONB.
         
@@ -130,6 +272,9 @@ class DatabaseClient:
             records: Lista de dicts para inserir como JSONB
             extra_columns: Colunas adicionais com valores fixos
             batch_size: Tamanho do batch
+            prepared: Usa statement preparado (loaders que repetem o mesmo shape)
+            use_copy: Acima de COPY_THRESHOLD carrega via copy_jsonb (opt-in:
+                COPY tem outra semântica de erro que o INSERT)
         
         Returns:
             Número total de registros inseridos
@@ -137,42 +282,107 @@ class DatabaseClient:
         if not records:
             return 0
         
+        if use_copy and len(records) > self.COPY_THRESHOLD and not prepared:
+            return self.copy_jsonb(schema, table, records, extra_columns)
+        
+        from psycopg2.extras import execute_values
+        
         extra_columns = extra_columns or {}
         extra_cols = list(extra_columns.keys())
-        extra_vals = list(extra_columns.values())
+        extra_vals = tuple(extra_columns.values())
         
-        # Monta a query
+        # Monta a query (execute_values expande "VALUES %s" em multi-row por página)
         cols = ["payload"] + extra_cols
-        placeholders = ["%s"] * len(cols)
+        template = f"({', '.join(['%s'] * len(cols))})"
+        
+        insert = f'INSERT INTO "{schema}"."{table}" ({", ".join(cols)})'
+        
+        # Gerador: execute_values consome as linhas sob demanda, página a página
+        wrap = _json_adapter()
+        rows = ((wrap(record), *extra_vals) for record in records)
+        with self.cursor() as cur:
+            if prepared:
+                params = ", ".join(f"${i}" for i in range(1, len(cols) + 1))
+                self._execute_prepared(cur, f"{insert} VALUES ({params})",
+                                       rows, len(cols), batch_size)
+            else:
+                execute_values(cur, f"{insert} VALUES %s", rows,
+                               template=template, page_size=batch_size)
+        
+        return len(records)
+    
+    def copy_jsonb(self, schema: str, table: str,
+                   records: List[Dict[str, Any]],
+                   extra_columns: Dict[str, Any] = None) -> int:
+        """
+        Carrega registros JSONB via COPY FROM STDIN (formato text).
+        
+        Evita o parser SQL do servidor; indicado para cargas grandes
+        sem semântica de conflito.
+        
+        Args:
+            schema: Nome do schema
+            table: Nome da tabela
+            records: Lista de dicts para inserir como JSONB
+            extra_columns: Colunas adicionais com valores fixos
         
-        sql = f"""
-            INSERT INTO "{schema}"."{table}" ({", ".join(cols)})
-            VALUES ({", ".join(placeholders)})
+        Returns:
+            Número total de registros inseridos
         """
+        if not records:
+            return 0
         
-        total = 0
+        extra_columns = extra_columns or {}
+        cols = ["payload"] + list(extra_columns.keys())
+        
+        # Valores fixos são formatados uma única vez
+        extras = "".join("\t" + _copy_text(v) for v in extra_columns.values())
+        
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write(_copy_text(_dumps_json(record)))
+            buffer.write(extras)
+            buffer.write("\n")
+        buffer.seek(0)
+        
+        sql = f'COPY "{schema}"."{table}" ({", ".join(cols)}) FROM STDIN'
         with self.cursor() as cur:
-            batch = []
-            for record in records:
-                row = (Json(record),) + tuple(extra_vals)
-                batch.append(row)
-                
-                if len(batch) >= batch_size:
-                    cur.executemany(sql, batch)
-                    total += len(batch)
-                    batch = []
-            
-            if batch:
-                cur.executemany(sql, batch)
-                total += len(batch)
-        
-        return total
+            cur.copy_expert(sql, buffer)
+        
+        return len(records)
+    
+    def bulk_insert_jsonb_fast(self, schema: str, table: str,
+                               records: List[Dict[str, Any]],
+                               extra_columns: Dict[str, Any] = None) -> int:
+        """
+        Variante de bulk_insert_jsonb que usa asyncpg (COPY binário) para lotes grandes.
+        
+        Acima de COPY_THRESHOLD abre um AsyncDatabaseClient temporário e
+        executa a carga com asyncio.run; abaixo disso delega para
+        bulk_insert_jsonb. Requer asyncpg instalado.
+        """
+        if len(records) <= self.COPY_THRESHOLD:
+            return self.bulk_insert_jsonb(schema, table, records, extra_columns)
+        
+        async def _run() -> int:
+            client = AsyncDatabaseClient(
+                host=self.host, port=self.port, database=self.database,
+                user=self.user, password=self.password, sslmode=self.sslmode,
+                pool_size=1,
+            )
+            try:
+                return await client.bulk_insert_jsonb(schema, table, records, extra_columns)
+            finally:
+                await client.close()
+        
+        return asyncio.run(_run())
     
     def upsert_jsonb(self, schema: str, table: str,
                      records: List[Dict[str, Any]],
                      conflict_columns: List[str],
                      extra_columns: Dict[str, Any] = None,
-                     batch_size: int = 1000) -> Tuple[int, int]:
+                     batch_size: int = 1000,
+                     prepared: bool = False) -> Tuple[int, int]:
         """
         Faz UPSERT de registros com JSONB.
         
@@ -183,54 +393,149 @@ class DatabaseClient:
             conflict_columns: Colunas para detectar conflito
             extra_columns: Colunas adicionais
             batch_size: Tamanho do batch
+            prepared: Usa statement preparado (loaders que repetem o mesmo shape)
         
         Returns:
-            Tuple (inserted, updated)
+            Tuple (inserted, updated). Nos caminhos prepared/fallback
+            (execute_batch) o split não é observável: (total, 0).
         """
         if not records:
             return 0, 0
         
+        from psycopg2 import errors
+        from psycopg2.extras import execute_batch, execute_values
+        
         extra_columns = extra_columns or {}
         extra_cols = list(extra_columns.keys())
-        extra_vals = list(extra_columns.values())
+        extra_vals = tuple(extra_columns.values())
         
         cols = ["payload"] + extra_cols
-        placeholders = ["%s"] * len(cols)
+        template = f"({', '.join(['%s'] * len(cols))})"
         
         # Colunas para update (exceto as de conflito)
         update_cols = [c for c in cols if c not in conflict_columns]
         update_set = ", ".join([f"{c} = EXCLUDED.{c}" for c in update_cols])
         
-        sql = f"""
-            INSERT INTO "{schema}"."{table}" ({", ".join(cols)})
-            VALUES ({", ".join(placeholders)})
-            ON CONFLICT ({", ".join(conflict_columns)})
-            DO UPDATE SET {update_set}
-        """
+        insert = f'INSERT INTO "{schema}"."{table}" ({", ".join(cols)})'
+        on_conflict = (
+            f'ON CONFLICT ({", ".join(conflict_columns)}) '
+            f'DO UPDATE SET {update_set}'
+        )
         
-        total = 0
+        # Gerador: execute_values consome as linhas sob demanda, página a página
+        wrap = _json_adapter()
+        rows = ((wrap(record), *extra_vals) for record in records)
         with self.cursor() as cur:
-            batch = []
-            for record in records:
-                row = (Json(record),) + tuple(extra_vals)
-                batch.append(row)
-                
-                if len(batch) >= batch_size:
-                    cur.executemany(sql, batch)
-                    total += len(batch)
-                    batch = []
-            
-            if batch:
-                cur.executemany(sql, batch)
-                total += len(batch)
-        
-        return total, 0  # Postgres não diferencia facilmente insert/update
-
-
-def create_db_client() -> DatabaseClient:
+            if prepared:
+                params = ", ".join(f"${i}" for i in range(1, len(cols) + 1))
+                self._execute_prepared(cur, f"{insert} VALUES ({params}) {on_conflict}",
+                                       rows, len(cols), batch_size)
+            else:
+                # xmax = 0 só na versão recém-inserida; a contagem sai agregada
+                # no servidor (uma linha por página em vez de uma por registro)
+                sql = (
+                    f"WITH up AS ({insert} VALUES %s {on_conflict} "
+                    f"RETURNING (xmax = 0) AS inserted) "
+                    f"SELECT count(*) FILTER (WHERE inserted), "
+                    f"count(*) FILTER (WHERE NOT inserted) FROM up"
+                )
+                try:
+                    pages = execute_values(cur, sql, rows, template=template,
+                                           page_size=batch_size, fetch=True)
+                    return (sum(p[0] for p in pages), sum(p[1] for p in pages))
+                except (errors.SyntaxError, errors.CardinalityViolation):
+                    # VALUES multi-linha rejeitado (ex.: chave repetida na mesma
+                    # página): refaz a transação com um INSERT por linha,
+                    # ainda agrupados em page_size statements por envio
+                    cur.connection.rollback()
+                    rows = ((wrap(record), *extra_vals) for record in records)
+                    execute_batch(cur, f"{insert} VALUES {template} {on_conflict}",
+                                  rows, page_size=batch_size)
+        
+        # execute_batch descarta os resultados intermediários: sem split
+        return len(records), 0
+
+
+class AsyncDatabaseClient:
+    """
+    Cliente assíncrono (asyncpg) para caminhos de ingestão em alto volume.
+    
+    Usa o protocolo binário do asyncpg; bulk_insert_jsonb carrega via
+    copy_records_to_table (COPY binário).
+    """
+    
+    def __init__(self, host: str, port: int, database: str,
+                 user: str, password: str, sslmode: str = "require",
+                 pool_size: int = 5):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.user = user
+        self.password = password
+        self.sslmode = sslmode
+        self.pool_size = pool_size
+        self._pool = None
+    
+    async def connect(self):
+        """Inicializa (uma vez) o pool asyncpg."""
+        if self._pool is None:
+            import asyncpg  # dependência opcional, só para este cliente
+            self._pool = await asyncpg.create_pool(
+                host=self.host,
+                port=self.port,
+                database=self.database,
+                user=self.user,
+                password=self.password,
+                ssl=self.sslmode,
+                min_size=1,
+                max_size=self.pool_size,
+            )
+        return self._pool
+    
+    async def close(self):
+        """Fecha o pool."""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+    
+    async def bulk_insert_jsonb(self, schema: str, table: str,
+                                records: List[Dict[str, Any]],
+                                extra_columns: Dict[str, Any] = None) -> int:
+        """
+        Insere registros em massa via COPY binário.
+        
+        Args:
+            schema: Nome do schema
+            table: Nome da tabela
+            records: Lista de dicts para inserir como JSONB
+            extra_columns: Colunas adicionais com valores fixos
+        
+        Returns:
+            Número total de registros inseridos
+        """
+        if not records:
+            return 0
+        
+        extra_columns = extra_columns or {}
+        extra_vals = tuple(extra_columns.values())
+        rows = [(_dumps_json(record), *extra_vals) for record in records]
+        
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                table,
+                schema_name=schema,
+                columns=["payload", *extra_columns],
+                records=rows,
+            )
+        
+        return len(rows)
+
+
+def create_db_client(pool_size: int = 5) -> DatabaseClient:
     """Factory para criar cliente do banco com configurações do ambiente."""
-    import sys
-    sys.path.insert(0, str(__file__).replace("/src/common/db.py", ""))
+    if _PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, _PROJECT_ROOT)
     from config.settings import postgres
     
     return DatabaseClient(
@@ -239,5 +544,6 @@ def create_db_client() -> DatabaseClient:
         database=postgres.DATABASE,
         user=postgres.USER,
         password=postgres.PASSWORD,
-        sslmode=postgres.SSLMODE
+        sslmode=postgres.SSLMODE,
+        pool_size=pool_size,
     )
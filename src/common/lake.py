@@ -2,10 +2,53 @@
 """
 Utilitários para operações no Azure Data Lake Storage Gen2.
 """
-import gzip
 import json
-from typing import Any, Dict, List, Optional, Iterator
-from azure.storage.blob import BlobServiceClient, ContentSettings
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Iterator, Tuple
+from azure.storage.blob import BlobPrefix, BlobServiceClient, ContentSettings
+
+try:
+    from isal import isal_zlib as zlib  # descompressão acelerada (ISA-L)
+except ImportError:
+    import zlib
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # json.loads também aceita bytes UTF-8
+    orjson = None
+    _loads = json.loads
+
+# Raiz do projeto (para importar config.settings), resolvida uma única vez
+_PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
+
+# Máximo de BlobClients memoizados por LakeClient
+BLOB_CLIENT_CACHE_SIZE = 4096
+
+# Validade (s) do cache de listagens/latest_run_id dentro do processo
+LISTING_CACHE_TTL = 60.0
+
+# Fontes cujos extratores gravam _meta/{source}/latest_run_id.txt
+LATEST_RUN_POINTER_SOURCES = frozenset({"pipedrive", "zendesk"})
+
+
+def _scan_lines(buf: bytes):
+    """
+    Emite os registros das linhas completas de buf e retorna o resto.
+    
+    Varre por \\n direto nos bytes (sem decode/split/strip por linha).
+    """
+    pos = 0
+    while True:
+        nl = buf.find(b"\n", pos)
+        if nl < 0:
+            return buf[pos:]
+        line = buf[pos:nl]
+        pos = nl + 1
+        if line and not line.isspace():
+            yield _loads(line)
 
 
 class LakeClient:
@@ -17,6 +60,8 @@ class LakeClient:
         self.container_name = container
         self._service_client = None
         self._container_client = None
+        self._blob_clients: Dict[str, Any] = {}
+        self._cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
     
     @property
     def service_client(self) -> BlobServiceClient:
@@ -34,15 +79,37 @@ class LakeClient:
             self._container_client = self.service_client.get_container_client(self.container_name)
         return self._container_client
     
+    def _cached(self, key: Tuple[str, str], compute: Callable[[], Any]) -> Any:
+        """Resultado de compute() memoizado por LISTING_CACHE_TTL segundos."""
+        now = time.monotonic()
+        hit = self._cache.get(key)
+        if hit is not None and now - hit[0] < LISTING_CACHE_TTL:
+            return hit[1]
+        value = compute()
+        self._cache[key] = (now, value)
+        return value
+    
+    def blob_client(self, path: str):
+        """BlobClient memoizado por path (evita refazer URL/pipeline a cada chamada)."""
+        bc = self._blob_clients.get(path)
+        if bc is None:
+            if len(self._blob_clients) >= BLOB_CLIENT_CACHE_SIZE:
+                self._blob_clients.clear()
+            bc = self._blob_clients[path] = self.container.get_blob_client(path)
+        return bc
+    
     def exists(self, path: str) -> bool:
         """Verifica se um blob existe."""
-        return self.container.get_blob_client(path).exists()
+        return self.blob_client(path).exists()
     
     def read_text(self, path: str) -> Optional[str]:
         """Lê conteúdo de texto de um blob."""
-        bc = self.container.get_blob_client(path)
+        bc = self.blob_client(path)
         try:
-            return bc.download_blob().readall().decode("utf-8")
+            # readall() junta os ranges (baixados em paralelo se grande); o
+            # readinto do SDK exige um stream (write/seek), não um buffer
+            data = bc.download_blob(max_concurrency=4).readall()
+            return data.decode("utf-8")
         except Exception:
             return None
     
@@ -56,25 +123,42 @@ class LakeClient:
         except json.JSONDecodeError:
             return None
     
-    def read_jsonl_gz(self, path: str) -> List[Dict[str, Any]]:
-        """Lê um arquivo .jsonl.gz e retorna lista de dicts."""
-        bc = self.container.get_blob_client(path)
+    def iter_jsonl_gz(self, path: str) -> Iterator[Dict[str, Any]]:
+        """
+        Lê um .jsonl.gz em streaming, registro a registro.
+        
+        Download em chunks + descompressão incremental: nunca materializa
+        o arquivo inteiro (comprimido ou não) em memória.
+        """
+        bc = self.blob_client(path)
         try:
-            compressed = bc.download_blob().readall()
-            decompressed = gzip.decompress(compressed).decode("utf-8")
-            records = []
-            for line in decompressed.strip().split("\n"):
-                if line.strip():
-                    records.append(json.loads(line))
-            return records
+            stream = bc.download_blob(max_concurrency=4)
+            decomp = zlib.decompressobj(31)  # wbits=31: container gzip
+            buf = b""
+            for chunk in stream.chunks():
+                # Arquivo pode ser vários membros gzip concatenados (appends
+                # dos extratores): ao fim de um membro, o resto abre outro
+                while chunk:
+                    if decomp.eof:
+                        decomp = zlib.decompressobj(31)
+                    buf += decomp.decompress(chunk)
+                    chunk = decomp.unused_data
+                buf = yield from _scan_lines(buf)
+            # "\n" final garante que a última linha (sem quebra) seja emitida
+            yield from _scan_lines(buf + decomp.flush() + b"\n")
         except Exception as e:
             raise RuntimeError(f"Erro ao ler {path}: {e}")
     
+    def read_jsonl_gz(self, path: str) -> List[Dict[str, Any]]:
+        """Lê um arquivo .jsonl.gz e retorna lista de dicts."""
+        return list(self.iter_jsonl_gz(path))
+    
     def write_bytes(self, path: str, data: bytes, 
                     content_type: str = "application/octet-stream",
                     overwrite: bool = True) -> None:
-        """Escreve bytes em um blob."""
-        bc = self.container.get_blob_client(path)
+        """Escreve bytes em um blob (invalida o cache de listagens)."""
+        self._cache.clear()
+        bc = self.blob_client(path)
         bc.upload_blob(
             data, 
             overwrite=overwrite,
@@ -90,12 +174,23 @@ class LakeClient:
             overwrite=overwrite
         )
     
-    def write_json(self, path: str, obj: Any, overwrite: bool = True) -> None:
-        """Escreve objeto como JSON em um blob."""
-        text = json.dumps(obj, ensure_ascii=False, indent=2)
+    def write_json(self, path: str, obj: Any, overwrite: bool = True,
+                   pretty: bool = False) -> None:
+        """
+        Escreve objeto como JSON compacto (UTF-8) em um blob.
+        
+        pretty=True indenta (só para inspeção manual).
+        """
+        if pretty:
+            data = json.dumps(obj, ensure_ascii=False, indent=2, default=str).encode("utf-8")
+        elif orjson is not None:
+            data = orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            data = json.dumps(obj, ensure_ascii=False, separators=(",", ":"),
+                              default=str).encode("utf-8")
         self.write_bytes(
             path, 
-            text.encode("utf-8"), 
+            data, 
             content_type="application/json",
             overwrite=overwrite
         )
@@ -105,40 +200,57 @@ class LakeClient:
         for blob in self.container.list_blobs(name_starts_with=prefix):
             yield blob.name
     
+    def list_prefixes(self, prefix: str) -> Iterator[str]:
+        """Lista só os "diretórios" imediatamente abaixo do prefixo (delimiter='/')."""
+        for item in self.container.walk_blobs(name_starts_with=prefix, delimiter="/"):
+            if isinstance(item, BlobPrefix):
+                yield item.name
+    
     def list_blobs_details(self, prefix: str) -> Iterator[Dict[str, Any]]:
-        """Lista blobs com metadados."""
-        for blob in self.container.list_blobs(name_starts_with=prefix):
-            yield {
-                "name": blob.name,
-                "size": blob.size,
-                "last_modified": blob.last_modified,
-                "content_type": blob.content_settings.content_type if blob.content_settings else None,
-            }
+        """Lista blobs com metadados (cache de LISTING_CACHE_TTL segundos)."""
+        def compute():
+            return [
+                {
+                    "name": blob.name,
+                    "size": blob.size,
+                    "last_modified": blob.last_modified,
+                    "content_type": blob.content_settings.content_type if blob.content_settings else None,
+                }
+                for blob in self.container.list_blobs(name_starts_with=prefix)
+            ]
+        return iter(self._cached(("details", prefix), compute))
     
     def get_latest_run_id(self, source: str, scope: str = None) -> Optional[str]:
         """
         Encontra o run_id mais recente para uma fonte.
-        Procura em _meta/{source}/runs/ pelo manifest mais recente.
-        """
-        prefix = f"_meta/{source}/runs/"
-        manifests = []
         
-        for blob_name in self.list_blobs(prefix):
-            if blob_name.endswith("/manifest.json"):
-                # Extrai run_id do path: _meta/{source}/runs/run_id={id}/manifest.json
-                parts = blob_name.split("/")
-                for part in parts:
-                    if part.startswith("run_id="):
-                        run_id = part.replace("run_id=", "")
-                        manifests.append((run_id, blob_name))
-                        break
+        Nas fontes de LATEST_RUN_POINTER_SOURCES lê o ponteiro
+        _meta/{source}/latest_run_id.txt (gravado pelo extrator junto com o
+        manifest): um GET em vez de listar os runs. Nas demais, ou sem
+        ponteiro, procura em _meta/{source}/runs/ pelo manifest mais recente.
+        O resultado fica em cache por LISTING_CACHE_TTL segundos.
+        """
+        return self._cached(("latest_run_id", source),
+                            lambda: self._find_latest_run_id(source))
+    
+    def _find_latest_run_id(self, source: str) -> Optional[str]:
+        if source in LATEST_RUN_POINTER_SOURCES:
+            pointer = self.read_text(f"_meta/{source}/latest_run_id.txt")
+            if pointer and pointer.strip():
+                return pointer.strip()
         
-        if not manifests:
-            return None
+        prefix = f"_meta/{source}/runs/"
         
-        # Ordena por run_id (formato timestamp) e pega o mais recente
-        manifests.sort(key=lambda x: x[0], reverse=True)
-        return manifests[0][0]
+        # Só os diretórios run_id=.../ (não enumera os arquivos de cada run);
+        # run_id é timestamp, então a ordem lexicográfica é a cronológica
+        return max(
+            (
+                part[len("run_id="):]
+                for part in (p.rsplit("/", 2)[-2] for p in self.list_prefixes(prefix))
+                if part.startswith("run_id=")
+            ),
+            default=None,
+        )
     
     def get_bronze_parts(self, source: str, entity: str, 
                          scope: str = None, run_id: str = None,
@@ -172,8 +284,8 @@ class LakeClient:
 def create_lake_client() -> LakeClient:
     """Factory para criar cliente do lake com configurações do ambiente."""
     # Import aqui para evitar circular import
-    import sys
-    sys.path.insert(0, str(__file__).replace("/src/common/lake.py", ""))
+    if _PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, _PROJECT_ROOT)
     from config.settings import azure_storage
     
     return LakeClient(
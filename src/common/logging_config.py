@@ -2,11 +2,67 @@
 """
 Configuração de logging padronizada para o projeto.
 """
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
+
+
+class _FileRouter(logging.Handler):
+    """Encaminha cada registro para o FileHandler do logger de origem."""
+    
+    def __init__(self):
+        super().__init__()
+        self.routes: Dict[str, logging.Handler] = {}
+    
+    def emit(self, record: logging.LogRecord) -> None:
+        handler = self.routes.get(getattr(record, "route", None))
+        if handler is not None:
+            handler.handle(record)
+
+
+class _RoutedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que marca o registro com o logger dono do arquivo."""
+    
+    def __init__(self, q, route: str):
+        super().__init__(q)
+        self.route = route
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.route = self.route  # inclui registros propagados de loggers filhos
+        return record
+
+
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_router = _FileRouter()
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_lock = threading.Lock()
+
+
+def _file_queue_handler(name: str, file_handler: logging.Handler) -> logging.Handler:
+    """
+    Registra o FileHandler no listener compartilhado e retorna o QueueHandler
+    do logger: a escrita em disco sai da thread que loga (vira um put na fila).
+    """
+    global _listener
+    old = _router.routes.pop(name, None)
+    if old is not None:
+        old.close()
+    _router.routes[name] = file_handler
+    
+    with _listener_lock:
+        if _listener is None:
+            _listener = logging.handlers.QueueListener(_log_queue, _router)
+            _listener.start()
+            atexit.register(_listener.stop)  # drena a fila antes de sair
+    
+    return _RoutedQueueHandler(_log_queue, name)
 
 
 def setup_logger(
@@ -58,7 +114,7 @@ def setup_logger(
         
         file_handler = logging.FileHandler(log_file, encoding="utf-8")
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        logger.addHandler(_file_queue_handler(name, file_handler))
     
     return logger
 
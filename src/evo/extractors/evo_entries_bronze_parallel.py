@@ -12,7 +12,8 @@ CARACTERÍSTICAS DA API:
 
 ESTRATÉGIA DE EXTRAÇÃO:
 - Particiona por SEMANA (não mês) devido ao volume
-- 8 workers paralelos
+- 8 semanas simultâneas (--workers) em um único event loop
+- Dentro da semana, páginas em paralelo (PAGE_CONCURRENCY)
 - take=1000 para maximizar eficiência
 
 ESTIMATIVA DE TEMPO:
@@ -33,19 +34,34 @@ Uso:
     python src/extractors/evo_entries_bronze_parallel.py --start-date 2020-01-01 --end-date 2026-01-11 --workers 12
 """
 import argparse
-import gzip
+import asyncio
 import json
 import logging
 import os
 import sys
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 
+try:
+    import httpx  # HTTP/2 + pool keep-alive (requer httpx[http2])
+except ImportError:
+    httpx = None
+
+try:
+    from isal import igzip as gzip  # ISA-L: mesma API do gzip, bem mais rápido
+except ImportError:
+    import gzip
+
+try:
+    import orjson
+except ImportError:  # fallback: json da stdlib
+    orjson = None
+
 # Silencia logs verbosos
 logging.getLogger("azure").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -117,158 +133,303 @@ def validate_env():
     print(f"[ENV] EVO User: {ENV['EVO_USERNAME']}")
 
 
+def serialize_jsonl(records: List[Dict]) -> bytes:
+    """Serializa registros como JSONL (UTF-8, uma linha por registro)."""
+    if orjson is not None:
+        dumps = orjson.dumps
+        opt = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+        return b"".join(dumps(r, default=str, option=opt) for r in records)
+    lines = [json.dumps(r, ensure_ascii=False, default=str) for r in records]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# Páginas (skip) buscadas em paralelo dentro de cada semana
+PAGE_CONCURRENCY = 8
+
+
+def free_window() -> Tuple[float, float]:
+    """Janela livre (0h-5h locais) atual ou próxima, em instantes de time.monotonic()."""
+    now = datetime.now()
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = start.replace(hour=5)
+    if now >= end:
+        start += timedelta(days=1)
+        end += timedelta(days=1)
+    mono = time.monotonic()
+    return mono + (start - now).total_seconds(), mono + (end - now).total_seconds()
+
+
 class RateLimiter:
     """Rate limiter - janela livre 0h-5h permite mais velocidade."""
     def __init__(self, rpm: int = 40):
         self.min_interval = 60.0 / rpm
-        self.last_request = 0
+        self.last_request = 0.0
         self.count = 0
+        self._lock = asyncio.Lock()
+        # Relógio monotônico: a hora local só é consultada ao cruzar a janela
+        self._free_start, self._free_end = free_window()
     
-    def wait(self):
-        hour = datetime.now().hour
+    def _delay(self) -> float:
+        """Reserva o próximo slot e retorna quanto esperar por ele."""
+        self.count += 1
+        now = time.monotonic()
+        if now >= self._free_end:
+            self._free_start, self._free_end = free_window()
         # Janela livre: 0h-5h - sem rate limit
-        if 0 <= hour < 5:
-            time.sleep(0.01)  # Mínimo delay
-            self.count += 1
-            return
+        if now >= self._free_start:
+            return 0.01  # Mínimo delay
         
-        elapsed = time.time() - self.last_request
-        if elapsed < self.min_interval:
-            time.sleep(self.min_interval - elapsed)
-        self.last_request = time.time()
-        self.count += 1
+        slot = max(now, self.last_request + self.min_interval)
+        self.last_request = slot
+        return slot - now
+    
+    def wait(self):
+        time.sleep(self._delay())
+    
+    async def wait_async(self):
+        """Versão para corrotinas: os slots continuam espaçados entre elas."""
+        async with self._lock:
+            delay = self._delay()
+        await asyncio.sleep(delay)
+
+
+# Páginas de ~1-5MB de JSON comprimem ~10x: pede gzip explicitamente
+HTTP_HEADERS = {"Accept-Encoding": "gzip, deflate"}
 
 
-def extract_period_worker(args: Tuple) -> Dict:
+class _ThreadedSession:
+    """Adapta requests.Session para uso com await (fallback sem httpx)."""
+    def __init__(self, auth: Tuple[str, str]):
+        self._session = requests.Session()
+        self._session.auth = auth
+        self._session.headers.update(HTTP_HEADERS)
+    
+    async def get(self, url: str, **kwargs):
+        return await asyncio.to_thread(self._session.get, url, **kwargs)
+    
+    async def aclose(self):
+        self._session.close()
+
+
+def create_http_client(env: Dict):
+    """
+    Cliente HTTP assíncrono do worker: httpx com HTTP/2 e conexões
+    keep-alive e respostas gzip; sem httpx, requests.Session em threads.
     """
-    Worker que extrai um período específico (1 semana).
+    auth = (env["EVO_USERNAME"], env["EVO_PASSWORD"])
+    if httpx is not None:
+        return httpx.AsyncClient(
+            http2=True,
+            auth=auth,
+            headers=HTTP_HEADERS,
+            timeout=120.0,
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+        )
+    return _ThreadedSession(auth)
+
+
+def create_container_client(env: Dict):
+    """
+    ContainerClient no endpoint blob: o namespace hierárquico do ADLS é
+    transparente e cada part sobe em um único PUT (BlockBlob), em vez do
+    create + append + flush do DataLakeFileClient.
+    """
+    from azure.storage.blob import BlobServiceClient
+    
+    service = BlobServiceClient(
+        account_url=f"https://{env['AZURE_STORAGE_ACCOUNT_NAME']}.blob.core.windows.net",
+        credential=env["AZURE_STORAGE_ACCOUNT_KEY"]
+    )
+    return service.get_container_client(env["AZURE_CONTAINER_NAME"])
+
+
+def _upload(container, path: str, data: bytes) -> None:
+    """Envia um part para o lake (roda no pool de upload)."""
+    from azure.storage.blob import ContentSettings
+    
+    container.get_blob_client(path).upload_blob(
+        data,
+        overwrite=True,
+        max_concurrency=4,
+        content_settings=ContentSettings(content_type="application/gzip"),
+    )
+
+
+class PeriodError(Exception):
+    """Falha que encerra a extração do período."""
+
+
+async def run_periods(periods: List[Tuple[str, str]], base_path: str,
+                      workers: int, env: Dict, container) -> List[Dict]:
     """
-    start_date, end_date, run_id, worker_id, env_copy = args
+    Executa todos os períodos em um único event loop.
     
-    from azure.storage.filedatalake import DataLakeServiceClient
+    Até `workers` semanas simultâneas (semáforo), compartilhando um cliente
+    HTTP, um cliente do lake e um pool de upload. Dentro de cada semana as
+    páginas (skip) são buscadas em ondas de PAGE_CONCURRENCY requests.
+    """
+    sem = asyncio.Semaphore(workers)
+    client = create_http_client(env)
+    uploader = ThreadPoolExecutor(max_workers=4 * workers)
     
-    rate_limiter = RateLimiter(rpm=40)
-    session = requests.Session()
-    session.auth = (env_copy["EVO_USERNAME"], env_copy["EVO_PASSWORD"])
+    async def run_one(worker_id: int, start_date: str, end_date: str) -> Dict:
+        async with sem:
+            try:
+                return await extract_period_async(
+                    start_date, end_date, base_path, worker_id, env,
+                    client, container, uploader,
+                )
+            except Exception as e:
+                return {"error": f"Erro fatal: {e}", "period": f"{start_date} - {end_date}"}
     
-    # Azure client
+    results = []
     try:
-        service = DataLakeServiceClient(
-            account_url=f"https://{env_copy['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
-            credential=env_copy["AZURE_STORAGE_ACCOUNT_KEY"]
-        )
-        fs = service.get_file_system_client(env_copy["AZURE_CONTAINER_NAME"])
-    except Exception as e:
-        return {"error": f"Azure connection failed: {e}", "period": f"{start_date} - {end_date}"}
+        tasks = [run_one(i % workers, p[0], p[1]) for i, p in enumerate(periods)]
+        for coro in asyncio.as_completed(tasks):
+            result = await coro
+            results.append(result)
+            
+            if "error" not in result:
+                print(f"✓ {result['period']}: {result['records']:,} entries em {result['elapsed']:.0f}s")
+            else:
+                print(f"✗ {result['period']}: {result['error']}")
+    finally:
+        await client.aclose()
+        uploader.shutdown(wait=True)
+    
+    return results
+
+
+async def extract_period_async(start_date: str, end_date: str, base_path: str,
+                               worker_id: int, env: Dict, client, container,
+                               uploader: ThreadPoolExecutor) -> Dict:
+    """Extrai um período específico (1 semana)."""
+    rate_limiter = RateLimiter(rpm=40)
     
-    base_path = f"bronze/evo/entity=entries/ingestion_date={datetime.now(timezone.utc).strftime('%Y-%m-%d')}/run_id={run_id}"
+    tag = f"[Worker {worker_id}]"  # prefixo de log, formatado uma vez
+    url = f"{env['EVO_API_URL']}/api/v1/entries"
+    take = 1000  # MÁXIMO permitido para entries!
+    max_retries = 5
+    
+    async def fetch_page(skip: int) -> Optional[List[Dict]]:
+        """Busca uma página; None = página pulada após 500 persistente."""
+        params = {
+            "skip": skip,
+            "take": take,
+            "registerDateStart": f"{start_date}T00:00:00",
+            "registerDateEnd": f"{end_date}T23:59:59",
+        }
+        retry_count = 0
+        while True:
+            await rate_limiter.wait_async()
+            try:
+                resp = await client.get(url, params=params, timeout=120)
+                
+                if resp.status_code == 401:
+                    raise PeriodError("401 Unauthorized")
+                
+                if resp.status_code == 500:
+                    retry_count += 1
+                    if retry_count > max_retries:
+                        print(f"{tag} ⚠️ 500 persistente em {start_date} skip={skip} - pulando")
+                        return None
+                    print(f"{tag} ⚠️ 500 em {start_date} skip={skip} - retry {retry_count}/{max_retries}")
+                    await asyncio.sleep(5)
+                    continue
+                
+                resp.raise_for_status()
+                # orjson parseia os bytes crus (sem decode para str)
+                data = orjson.loads(resp.content) if orjson is not None else resp.json()
+                return data if isinstance(data, list) else data.get("data", [])
+            
+            except PeriodError:
+                raise
+            except Exception as e:
+                retry_count += 1
+                if retry_count > max_retries:
+                    print(f"{tag} Erro persistente em {start_date}: {e}")
+                    raise PeriodError(str(e)) from e
+                print(f"{tag} Erro em {start_date}: {e} - retry {retry_count}/{max_retries}")
+                await asyncio.sleep(5)
+    
+    def upload_part(final: bool = False):
+        nonlocal buffer, buffer_count, part_num
+        part_num += 1
+        part_name = f"{prefix}part-{part_num:05d}.jsonl.gz"
+        
+        compressed = gzip.compress(buffer, compresslevel=1)
+        
+        # Upload em background: a próxima onda de páginas já começa a baixar
+        pending_uploads.append(
+            uploader.submit(_upload, container, f"{base_path}/{part_name}", compressed)
+        )
+        
+        suffix = " - FINAL" if final else ""
+        print(part_tag, f"{part_name} ({buffer_count:,} entries){suffix}")
+        buffer = bytearray()
+        buffer_count = 0
     
     skip = 0
-    take = 1000  # MÁXIMO permitido para entries!
-    buffer = []
+    # Buffer = bytes JSONL já serializados (não mantém 10k dicts em memória)
+    buffer = bytearray()
+    buffer_count = 0
     part_num = 0
     total = 0
     batch_size = 10000  # Maior batch pois registros são menores
     prefix = f"{start_date[:10]}_"  # YYYY-MM-DD
+    part_tag = f"{tag} {prefix}:"
     
     start_time = time.time()
-    retry_count = 0
-    max_retries = 5
+    pending_uploads = []
     
-    while True:
-        try:
-            rate_limiter.wait()
-            
-            url = f"{env_copy['EVO_API_URL']}/api/v1/entries"
-            params = {
-                "skip": skip,
-                "take": take,
-                "registerDateStart": f"{start_date}T00:00:00",
-                "registerDateEnd": f"{end_date}T23:59:59",
-            }
-            
-            resp = session.get(url, params=params, timeout=120)
-            
-            if resp.status_code == 401:
-                return {"error": "401 Unauthorized", "period": f"{start_date} - {end_date}"}
+    try:
+        done = False
+        while not done:
+            # Paginação por skip/take é stateless: uma onda de páginas em
+            # paralelo; a última onda pode buscar algumas páginas vazias
+            skips = [skip + i * take for i in range(PAGE_CONCURRENCY)]
+            pages = await asyncio.gather(*(fetch_page(s) for s in skips))
             
-            if resp.status_code == 500:
-                retry_count += 1
-                if retry_count > max_retries:
-                    print(f"[Worker {worker_id}] ⚠️ 500 persistente em {start_date} skip={skip} - pulando")
-                    skip += take
-                    retry_count = 0
+            for records in pages:
+                if records is None:  # página pulada (500 persistente)
                     continue
-                print(f"[Worker {worker_id}] ⚠️ 500 em {start_date} skip={skip} - retry {retry_count}/{max_retries}")
-                time.sleep(5)
-                continue
-            
-            resp.raise_for_status()
-            data = resp.json()
-            retry_count = 0
-            
-            records = data if isinstance(data, list) else data.get("data", [])
-            
-            if not records:
-                break
-            
-            buffer.extend(records)
-            total += len(records)
-            
-            # Salva part quando buffer atinge limite
-            if len(buffer) >= batch_size:
-                part_num += 1
-                part_name = f"{prefix}part-{part_num:05d}.jsonl.gz"
                 
-                lines = [json.dumps(r, ensure_ascii=False, default=str) for r in buffer]
-                content = '\n'.join(lines).encode('utf-8')
-                compressed = gzip.compress(content)
+                buffer += serialize_jsonl(records)
+                buffer_count += len(records)
+                total += len(records)
                 
-                file_client = fs.get_file_client(f"{base_path}/{part_name}")
-                file_client.upload_data(compressed, overwrite=True)
+                # Salva part quando buffer atinge limite
+                if buffer_count >= batch_size:
+                    upload_part()
                 
-                print(f"[Worker {worker_id}] {prefix}: {part_name} ({len(buffer):,} entries)")
-                buffer = []
-            
-            # Se retornou menos que take, acabou
-            if len(records) < take:
-                break
-            
-            skip += take
-            
-            # Log de progresso a cada 50k registros
-            if total % 50000 == 0:
-                elapsed = time.time() - start_time
-                rate = total / elapsed if elapsed > 0 else 0
-                print(f"[Worker {worker_id}] {start_date}: {total:,} entries ({rate:.0f}/s)")
-            
-        except Exception as e:
-            error_msg = str(e)
-            if "base64" in error_msg.lower():
-                return {"error": f"Azure Key inválida: {error_msg}", "period": f"{start_date} - {end_date}"}
-            
-            retry_count += 1
-            if retry_count > max_retries:
-                print(f"[Worker {worker_id}] Erro persistente em {start_date}: {e}")
-                return {"error": str(e), "period": f"{start_date} - {end_date}", "partial_records": total}
+                # Se retornou menos que take, acabou
+                if len(records) < take:
+                    done = True
+                    break
+                
+                # Log de progresso a cada 50k registros
+                if total % 50000 == 0:
+                    elapsed = time.time() - start_time
+                    rate = total / elapsed if elapsed > 0 else 0
+                    print(f"{tag} {start_date}: {total:,} entries ({rate:.0f}/s)")
             
-            print(f"[Worker {worker_id}] Erro em {start_date}: {e} - retry {retry_count}/{max_retries}")
-            time.sleep(5)
-            continue
-    
-    # Salva buffer restante
-    if buffer:
-        part_num += 1
-        part_name = f"{prefix}part-{part_num:05d}.jsonl.gz"
+            skip += take * PAGE_CONCURRENCY
         
-        lines = [json.dumps(r, ensure_ascii=False, default=str) for r in buffer]
-        content = '\n'.join(lines).encode('utf-8')
-        compressed = gzip.compress(content)
+        # Salva buffer restante
+        if buffer:
+            upload_part(final=True)
         
-        file_client = fs.get_file_client(f"{base_path}/{part_name}")
-        file_client.upload_data(compressed, overwrite=True)
-        
-        print(f"[Worker {worker_id}] {prefix}: {part_name} ({len(buffer):,} entries) - FINAL")
+        # Aguarda os uploads pendentes (propaga a primeira falha)
+        for future in pending_uploads:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception as e:
+                if "base64" in str(e).lower():
+                    raise PeriodError(f"Azure Key inválida: {e}") from e
+                raise PeriodError(str(e)) from e
+    
+    except PeriodError as e:
+        return {"error": str(e), "period": f"{start_date} - {end_date}", "partial_records": total}
     
     elapsed = time.time() - start_time
     
@@ -338,44 +499,17 @@ def main():
     est_hours = (est_records / 1000 / 40) / args.workers  # 1000/req, 40 req/min
     print(f"Estimativa: ~{est_records/1e6:.0f}M registros, ~{est_hours:.1f}h")
     
-    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime("%Y%m%dT%H%M%SZ")
+    # Calculado uma vez: parts e manifest sempre na mesma ingestion_date
+    base_path = f"bronze/evo/entity=entries/ingestion_date={started_at:%Y-%m-%d}/run_id={run_id}"
     print(f"Run ID: {run_id}")
     print("="*70)
     
-    # Cria cópia do ENV para workers
-    env_copy = {
-        "EVO_API_URL": ENV["EVO_API_URL"],
-        "EVO_USERNAME": ENV["EVO_USERNAME"],
-        "EVO_PASSWORD": ENV["EVO_PASSWORD"],
-        "AZURE_STORAGE_ACCOUNT_NAME": ENV["AZURE_STORAGE_ACCOUNT_NAME"],
-        "AZURE_STORAGE_ACCOUNT_KEY": ENV["AZURE_STORAGE_ACCOUNT_KEY"],
-        "AZURE_CONTAINER_NAME": ENV["AZURE_CONTAINER_NAME"],
-    }
-    
-    # Prepara args para workers
-    worker_args = [
-        (p[0], p[1], run_id, i % args.workers, env_copy)
-        for i, p in enumerate(periods)
-    ]
-    
-    # Executa
+    # Executa (um processo, um event loop: ENV é usado direto, sem cópia/pickle)
     start_time = time.time()
-    results = []
-    
-    with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        futures = {executor.submit(extract_period_worker, arg): arg for arg in worker_args}
-        
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                results.append(result)
-                
-                if "error" not in result:
-                    print(f"✓ {result['period']}: {result['records']:,} entries em {result['elapsed']:.0f}s")
-                else:
-                    print(f"✗ {result['period']}: {result['error']}")
-            except Exception as e:
-                print(f"✗ Erro fatal: {e}")
+    container = create_container_client(ENV)  # reusado para o manifest
+    results = asyncio.run(run_periods(periods, base_path, args.workers, ENV, container))
     
     total_elapsed = time.time() - start_time
     total_records = sum(r.get("records", 0) for r in results)
@@ -383,14 +517,7 @@ def main():
     errors = sum(1 for r in results if "error" in r)
     
     # Salva manifest
-    from azure.storage.filedatalake import DataLakeServiceClient
-    service = DataLakeServiceClient(
-        account_url=f"https://{ENV['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
-        credential=ENV["AZURE_STORAGE_ACCOUNT_KEY"]
-    )
-    fs = service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
-    
-    base_path = f"bronze/evo/entity=entries/ingestion_date={datetime.now(timezone.utc).strftime('%Y-%m-%d')}/run_id={run_id}"
+    from azure.storage.blob import ContentSettings
     
     manifest = {
         "entity": "entries",
@@ -407,8 +534,16 @@ def main():
         "results": results,
     }
     
-    content = json.dumps(manifest, indent=2, ensure_ascii=False, default=str)
-    fs.get_file_client(f"{base_path}/_manifest.json").upload_data(content.encode('utf-8'), overwrite=True)
+    # Manifest é lido por pipelines: JSON compacto
+    if orjson is not None:
+        content = orjson.dumps(manifest, default=str)
+    else:
+        content = json.dumps(manifest, ensure_ascii=False, separators=(",", ":"), default=str).encode('utf-8')
+    container.get_blob_client(f"{base_path}/_manifest.json").upload_blob(
+        content,
+        overwrite=True,
+        content_settings=ContentSettings(content_type="application/json"),
+    )
     
     print()
     print("="*70)
@@ -6,8 +6,9 @@ Extrai múltiplos períodos simultaneamente para acelerar drasticamente.
 
 ESTRATÉGIA:
 - Divide o período em chunks (meses)
-- Roda N workers em paralelo, cada um extraindo um mês diferente
-- Cada worker tem seu próprio rate limiter
+- Roda N meses em paralelo em um único event loop (asyncio + httpx)
+- Um único rate limiter compartilhado por todos os períodos: a taxa agregada
+  na API é --rpm (default: 40 por worker), independente do número de períodos
 
 Performance:
 - Serial: ~4 min/5k registros = 133h para 10M
@@ -27,20 +28,38 @@ Uso:
     python src/extractors/evo_sales_bronze_parallel.py --year 2024 --workers 4
 """
 import argparse
-import gzip
+import asyncio
+import calendar
+import io
 import json
 import logging
 import os
+import queue
 import sys
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from datetime import datetime, timezone, timedelta
-from multiprocessing import Manager
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timezone, timedelta
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 
+try:
+    import httpx
+except ImportError:  # fallback: requests em threads
+    httpx = None
+
+try:
+    from isal import igzip as gzip  # ISA-L: mesma API do gzip, bem mais rápido
+except ImportError:
+    import gzip
+
+try:
+    import orjson
+except ImportError:  # fallback: json da stdlib
+    orjson = None
+
 # Desabilita logging verboso do Azure SDK
 logging.getLogger("azure").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -54,6 +73,24 @@ PROJECT_ROOT = SCRIPT_DIR.parent.parent
 LOG_DIR = PROJECT_ROOT / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 
+# Logs do loop de extração: o event loop só enfileira; arquivo e console
+# são escritos pela thread do QueueListener (print no console do Windows
+# pode bloquear o loop)
+log = logging.getLogger("evo_sales")
+
+
+def start_log_listener(run_id: str) -> QueueListener:
+    """Liga o logger da run (arquivo em LOG_DIR + console) fora do event loop."""
+    q = queue.SimpleQueue()
+    file_handler = logging.FileHandler(LOG_DIR / f"evo_sales_{run_id}.log", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    listener = QueueListener(q, file_handler, logging.StreamHandler(sys.stdout))
+    log.addHandler(QueueHandler(q))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    return listener
+
 
 def load_env():
     """Carrega .env."""
@@ -87,157 +124,509 @@ ENV = {
 
 
 class RateLimiter:
-    """Rate limiter por worker."""
+    """Rate limiter único da run, compartilhado por todos os períodos."""
     
     def __init__(self, rpm: int = 40):
         self.min_interval = 60.0 / rpm
         self.last_request = 0
         self.count = 0
     
-    def wait(self):
+    def _delay(self) -> float:
+        """
+        Reserva o próximo slot e retorna quanto esperar por ele. Sem await
+        no meio, a reserva é atômica entre as corrotinas do event loop.
+        """
+        self.count += 1
         # Janela livre: sem limite
         hour = datetime.now().hour
         if 0 <= hour < 5:
-            time.sleep(0.02)
-            self.count += 1
-            return
+            return 0.02
         
-        elapsed = time.time() - self.last_request
-        if elapsed < self.min_interval:
-            time.sleep(self.min_interval - elapsed)
-        self.last_request = time.time()
-        self.count += 1
+        now = time.time()
+        slot = max(now, self.last_request + self.min_interval)
+        self.last_request = slot
+        return slot - now
+    
+    def wait(self):
+        time.sleep(self._delay())
+    
+    async def wait_async(self):
+        await asyncio.sleep(self._delay())
 
 
-def extract_period_worker(args: Tuple) -> Dict:
+# Sub-janelas de data dentro de cada período: o backend pagina com OFFSET
+# (custo O(skip)) e os 500 aparecem em skips altos
+INITIAL_WINDOW_DAYS = 7
+MAX_WINDOW_DAYS = 31
+MAX_PAGES_PER_WINDOW = 20
+
+
+class DateWindows:
     """
-    Worker que extrai um período específico.
-    Roda em processo separado.
+    Percorre [start_date, end_date] em sub-janelas adaptativas: a próxima
+    janela é dividida quando a atual precisou de muitas páginas e dobra
+    quando veio esparsa. O skip volta a zero a cada janela.
     """
-    start_date, end_date, run_id, show_receivables, worker_id = args
-    
+    def __init__(self, start_date: str, end_date: str, days: int = INITIAL_WINDOW_DAYS):
+        self.start = datetime.strptime(start_date, "%Y-%m-%d").date()
+        self.last = datetime.strptime(end_date, "%Y-%m-%d").date()
+        self.days = days
+        self.pages = 0
+    
+    @property
+    def end(self):
+        return min(self.start + timedelta(days=self.days - 1), self.last)
+    
+    def advance(self) -> bool:
+        """Fecha a janela atual; retorna False quando o período acabou."""
+        next_start = self.end + timedelta(days=1)
+        if self.pages > MAX_PAGES_PER_WINDOW and self.days > 1:
+            self.days //= 2
+        elif self.pages <= 1:
+            self.days = min(self.days * 2, MAX_WINDOW_DAYS)
+        self.start = next_start
+        self.pages = 0
+        return self.start <= self.last
+
+
+# Páginas (skip) buscadas em paralelo dentro de cada sub-janela
+PAGE_CONCURRENCY = 4
+
+
+class PeriodError(Exception):
+    """Falha que encerra a extração do período."""
+
+
+# Fatias de append no ADLS (Azure recomenda blocos de 4-256 MiB)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Part fechado pelo tamanho do JSONL (não por contagem fixa): registros
+# grandes não geram parts gigantes e registros pequenos não geram milhares
+TARGET_PART_BYTES = 64 * 1024 * 1024
+MAX_PART_RECORDS = 20000
+
+# Blocos do período são anexados (membros gzip concatenados) a um mesmo
+# arquivo até este volume de JSONL: menos arquivos para listar/abrir no
+# Bronze → STG, sem arquivos grandes demais para o loader descomprimir
+PERIOD_FILE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _upload_chunked(fs, path: str, data: bytes, chunk: int = UPLOAD_CHUNK_SIZE) -> None:
+    """
+    Envia o arquivo em fatias: create_file e append_data por fatia, com o
+    flush na última (arquivo pequeno = 2 requests). Um retry reenvia só a
+    fatia que falhou.
+    """
+    fc = fs.get_file_client(path)
+    fc.create_file()
+    if not data:
+        return
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk):
+        piece = view[offset:offset + chunk]
+        last = offset + chunk >= len(data)
+        fc.append_data(piece, offset=offset, length=len(piece), flush=last)
+
+
+def serialize_jsonl(records: List[Dict]) -> bytes:
+    """Serializa registros como JSONL (UTF-8, uma linha por registro)."""
+    if orjson is not None:
+        # orjson emite bytes UTF-8 direto, sem strings intermediárias
+        dumps = orjson.dumps
+        opt = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+        return b"".join(dumps(r, default=str, option=opt) for r in records)
+    # ensure_ascii padrão: escapar não-ASCII é mais rápido no encoder C e o
+    # gzip absorve a diferença de tamanho
+    return "".join(json.dumps(r, default=str) + "\n" for r in records).encode("ascii")
+
+
+class _AdlsAppendFile(io.RawIOBase):
+    """
+    Destino de escrita sobre um DataLakeFileClient: acumula os bytes e
+    envia um append_data a cada `block`. Só commit() faz o flush, então
+    uma falha no meio não publica um arquivo truncado.
+    """
+    def __init__(self, fc, block: int = UPLOAD_CHUNK_SIZE):
+        self.fc = fc
+        self.fc.create_file()
+        self.block = block
+        self.offset = 0
+        self.buf = bytearray()
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, b) -> int:
+        self.buf += b
+        if len(self.buf) >= self.block:
+            self._append()
+        return len(b)
+    
+    def _append(self, flush: bool = False):
+        # memoryview: o corpo do request sai direto do buffer, sem cópia
+        # (liberada antes do clear, que redimensiona o bytearray)
+        with memoryview(self.buf) as view:
+            self.fc.append_data(view, offset=self.offset, length=len(view), flush=flush)
+        self.offset += len(self.buf)
+        self.buf.clear()
+    
+    def commit(self):
+        # O último append já faz o flush: um request a menos por part
+        if self.buf:
+            self._append(flush=True)
+        else:
+            self.fc.flush_data(self.offset)
+
+
+class _PeriodFile:
+    """
+    Arquivo do período no ADLS montado por blocos: cada bloco vira um membro
+    gzip (concatenação de membros gzip é um gzip válido) anexado em ordem.
+    As tarefas rodam no pool de upload; cada uma espera a anterior.
+    """
+    def __init__(self, fs, path: str):
+        self.name = path.rsplit("/", 1)[-1]
+        self.fc = fs.get_file_client(path)
+        self.sink = None  # criado no primeiro bloco, já na thread do pool
+        self._last = None  # future da última tarefa (ordem dos appends)
+        self.committed = False
+    
+    def _chain(self, uploader: ThreadPoolExecutor, fn, *args) -> Future:
+        self._last = uploader.submit(fn, self._last, *args)
+        return self._last
+    
+    def add(self, uploader: ThreadPoolExecutor, data: bytes) -> Future:
+        return self._chain(uploader, self._write, data)
+    
+    def commit(self, uploader: ThreadPoolExecutor) -> Future:
+        return self._chain(uploader, self._commit)
+    
+    def discard(self, uploader: ThreadPoolExecutor) -> Future:
+        return self._chain(uploader, self._discard)
+    
+    def _write(self, prev: Optional[Future], data: bytes):
+        if prev is not None:
+            prev.result()  # propaga a falha do bloco anterior
+        if self.sink is None:
+            self.sink = _AdlsAppendFile(self.fc)
+        # gzip em streaming direto nos appends; nível 1: quase toda a redução
+        # de JSON textual a uma fração da CPU
+        view = memoryview(data)
+        with gzip.GzipFile(fileobj=self.sink, mode="wb", compresslevel=1) as gz:
+            for offset in range(0, len(data), UPLOAD_CHUNK_SIZE):
+                gz.write(view[offset:offset + UPLOAD_CHUNK_SIZE])
+    
+    def _commit(self, prev: Optional[Future]):
+        if prev is not None:
+            prev.result()
+        self.sink.commit()
+        self.committed = True
+    
+    def _discard(self, prev: Optional[Future]):
+        # Período abortado: espera as tarefas do arquivo e remove o que o
+        # create_file() já criou sem flush (não deixa part de zero bytes)
+        if prev is not None:
+            try:
+                prev.result()
+            except Exception:
+                pass
+        if self.sink is not None and not self.committed:
+            try:
+                self.fc.delete_file()
+            except Exception as e:
+                log.warning(f"Falha ao remover {self.name} incompleto: {e}")
+
+
+class _ThreadedSession:
+    """Adapta requests.Session para uso com await (fallback sem httpx)."""
+    def __init__(self, env: Dict):
+        self._session = requests.Session()
+        self._session.auth = (env["EVO_USERNAME"], env["EVO_PASSWORD"])
+        self._session.headers["Accept-Encoding"] = "gzip"
+    
+    async def get(self, url: str, **kwargs):
+        return await asyncio.to_thread(self._session.get, url, **kwargs)
+    
+    async def aclose(self):
+        self._session.close()
+
+
+def create_http_client(env: Dict, workers: int):
+    """
+    Cliente HTTP único do processo: httpx com HTTP/2, keep-alive e
+    respostas gzip; sem httpx, requests.Session em threads.
+    """
+    if httpx is not None:
+        return httpx.AsyncClient(
+            http2=True,
+            auth=(env["EVO_USERNAME"], env["EVO_PASSWORD"]),
+            headers={"Accept-Encoding": "gzip"},
+            timeout=120.0,
+            limits=httpx.Limits(max_connections=workers),
+        )
+    return _ThreadedSession(env)
+
+
+# Status que valem retry com backoff (mesma política do antigo Retry do urllib3)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_STATUS_RETRIES = 5
+
+
+async def get_with_retry(client, url: str, params: Dict):
+    """GET com backoff exponencial (1.5s, 3s, 6s...) para 429/5xx."""
+    for attempt in range(MAX_STATUS_RETRIES + 1):
+        resp = await client.get(url, params=params, timeout=120)
+        if resp.status_code not in RETRY_STATUS or attempt == MAX_STATUS_RETRIES:
+            return resp
+        await asyncio.sleep(1.5 * (2 ** attempt))
+    return resp
+
+
+def create_fs_client(env: Dict):
+    """FileSystemClient do ADLS, criado uma vez e compartilhado pelos períodos."""
     from azure.storage.filedatalake import DataLakeServiceClient
     
-    # Setup
-    rate_limiter = RateLimiter(rpm=40)
-    session = requests.Session()
-    session.auth = (ENV["EVO_USERNAME"], ENV["EVO_PASSWORD"])
-    
-    # Azure client
     service = DataLakeServiceClient(
-        account_url=f"https://{ENV['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
-        credential=ENV["AZURE_STORAGE_ACCOUNT_KEY"]
+        account_url=f"https://{env['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
+        credential=env["AZURE_STORAGE_ACCOUNT_KEY"]
     )
-    fs = service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
+    return service.get_file_system_client(env["AZURE_CONTAINER_NAME"])
+
+
+def period_weight(period: Tuple[str, str]) -> Tuple[int, str]:
+    """
+    Estimativa de volume do período para ordenar a execução: duração em
+    semanas (meses de 30/31 dias empatam; períodos parciais ficam por
+    último) e, no empate, o mais recente (a base cresce com o tempo).
+    """
+    start, end = (date.fromisoformat(d) for d in period)
+    return (end - start).days // 7, start.isoformat()
+
+
+async def run_periods(periods: List[Tuple[str, str]], base_path: str, show_receivables: bool,
+                      workers: int, rpm: int, env: Dict, fs) -> List[Dict]:
+    """
+    Executa todos os períodos em um único event loop: até `workers`
+    períodos simultâneos (semáforo) compartilhando o cliente HTTP, o
+    cliente do lake, o pool de upload e um único rate limiter: a taxa
+    agregada na API é `rpm`, independente do número de períodos.
+    """
+    sem = asyncio.Semaphore(workers)
+    rate_limiter = RateLimiter(rpm=rpm)
+    client = create_http_client(env, workers)
+    uploader = ThreadPoolExecutor(max_workers=2 * workers)
     
-    base_path = f"bronze/evo/entity=sales/ingestion_date={datetime.now(timezone.utc).strftime('%Y-%m-%d')}/run_id={run_id}"
+    async def run_one(worker_id: int, start_date: str, end_date: str) -> Dict:
+        async with sem:
+            try:
+                return await extract_period_async(
+                    start_date, end_date, base_path, show_receivables, worker_id, env,
+                    client, fs, uploader, rate_limiter,
+                )
+            except Exception as e:
+                return {"error": f"Erro fatal: {e}", "period": f"{start_date} - {end_date}"}
     
-    # Extração
+    results = []
+    try:
+        # Maiores primeiro (LPT): a cauda lenta começa cedo em vez de sobrar
+        # sozinha no fim; o semáforo libera na ordem de criação
+        ordered = sorted(periods, key=period_weight, reverse=True)
+        tasks = [run_one(i % workers, p[0], p[1]) for i, p in enumerate(ordered)]
+        for coro in asyncio.as_completed(tasks):
+            result = await coro
+            results.append(result)
+            
+            if "error" not in result:
+                log.info(f"✓ {result['period']}: {result['records']:,} registros em {result['elapsed']:.0f}s")
+            else:
+                log.warning(f"✗ {result['period']}: {result['error']}")
+    finally:
+        await client.aclose()
+        uploader.shutdown(wait=True)
+    
+    return results
+
+
+async def extract_period_async(start_date: str, end_date: str, base_path: str, show_receivables: bool,
+                               worker_id: int, env: Dict, client, fs, uploader: ThreadPoolExecutor,
+                               rate_limiter: RateLimiter) -> Dict:
+    """Extrai um período específico (um mês)."""
+    windows = DateWindows(start_date, end_date)
     skip = 0
     take = 100
-    buffer = []
-    part_num = 0
+    # Buffer = bytes JSONL já serializados por página (não mantém milhares
+    # de dicts em memória nem monta o part inteiro de uma vez no flush)
+    buffer = bytearray()
+    buffer_count = 0
+    blocks = 0
+    files = 0
+    period_file = None  # arquivo aberto do período
+    file_bytes = 0
     total = 0
-    batch_size = 5000
     prefix = f"{start_date[:7]}_"
     
     start_time = time.time()
+    pending = []  # uploads em andamento
+    opened = []  # arquivos do período (removidos se o período falhar)
+    
+    def add_block(final: bool = False):
+        nonlocal buffer, buffer_count, blocks, files, period_file, file_bytes
+        if period_file is None:
+            files += 1
+            period_file = _PeriodFile(fs, f"{base_path}/{prefix}part-{files:05d}.jsonl.gz")
+            opened.append(period_file)
+        blocks += 1
+        file_bytes += len(buffer)
+        
+        # gzip e upload em background: a paginação segue sem esperar
+        pending.append(period_file.add(uploader, buffer))
+        
+        suffix = " - FINAL" if final else ""
+        log.info(f"[Worker {worker_id}] {period_file.name}: bloco {blocks} ({buffer_count:,} registros, {len(buffer) / 1e6:.1f} MB){suffix}")
+        buffer = bytearray()
+        buffer_count = 0
+        
+        # Arquivo cheio ou fim do período: um único flush publica o arquivo
+        if final or file_bytes >= PERIOD_FILE_MAX_BYTES:
+            pending.append(period_file.commit(uploader))
+            period_file = None
+            file_bytes = 0
+    
+    async def abort(error: str) -> Dict:
+        """Falha no período: espera os uploads e remove os arquivos sem commit."""
+        for f in opened:
+            pending.append(f.discard(uploader))
+        for future in pending:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception:
+                pass
+        return {"error": error, "period": f"{start_date} - {end_date}"}
+    requests_made = 0
+    
+    # URL e params montados uma vez: por request muda só skip (e as datas
+    # a cada sub-janela)
+    url = f"{env['EVO_API_URL']}/api/v2/sales"
+    params = {
+        "skip": skip,
+        "take": take,
+        "showReceivables": str(show_receivables).lower(),
+        "dateSaleStart": windows.start.isoformat(),
+        "dateSaleEnd": windows.end.isoformat(),
+    }
     
-    while True:
-        try:
-            rate_limiter.wait()
-            
-            url = f"{ENV['EVO_API_URL']}/api/v2/sales"
-            params = {
-                "skip": skip,
-                "take": take,
-                "showReceivables": str(show_receivables).lower(),
-                "dateSaleStart": start_date,
-                "dateSaleEnd": end_date,
-            }
-            
-            resp = session.get(url, params=params, timeout=120)
-            
-            if resp.status_code == 401:
-                return {"error": "401 Unauthorized", "period": f"{start_date} - {end_date}"}
-            
-            resp.raise_for_status()
-            data = resp.json()
-            
-            records = data if isinstance(data, list) else data.get("data", [])
-            
-            if not records:
-                break
-            
-            buffer.extend(records)
-            total += len(records)
-            
-            # Salva part
-            if len(buffer) >= batch_size:
-                part_num += 1
-                part_name = f"{prefix}part-{part_num:05d}.jsonl.gz"
+    async def fetch_page(page_skip: int) -> List[Dict]:
+        """Busca uma página da sub-janela atual (erros transitórios: retry)."""
+        nonlocal requests_made
+        page_params = {**params, "skip": page_skip}
+        while True:
+            try:
+                await rate_limiter.wait_async()
+                requests_made += 1
                 
-                lines = [json.dumps(r, ensure_ascii=False, default=str) for r in buffer]
-                content = '\n'.join(lines).encode('utf-8')
-                compressed = gzip.compress(content)
+                resp = await get_with_retry(client, url, page_params)
                 
-                file_client = fs.get_file_client(f"{base_path}/{part_name}")
-                file_client.upload_data(compressed, overwrite=True)
+                if resp.status_code == 401:
+                    raise PeriodError("401 Unauthorized")
                 
-                print(f"[Worker {worker_id}] {prefix}: {part_name} ({len(buffer):,} registros)")
-                buffer = []
+                resp.raise_for_status()
+                # orjson parseia os bytes crus (sem decode para str)
+                data = orjson.loads(resp.content) if orjson is not None else resp.json()
+                return data if isinstance(data, list) else data.get("data", [])
             
-            if len(records) < take:
-                break
+            except PeriodError:
+                raise
+            except Exception as e:
+                log.warning(f"[Worker {worker_id}] Erro em {start_date}: {e}")
+                await asyncio.sleep(5)
+    
+    # Páginas (skip) da sub-janela em ondas paralelas: começa com 1 e dobra
+    # a cada onda cheia até PAGE_CONCURRENCY (janelas esparsas não
+    # desperdiçam requests em páginas vazias)
+    wave = 1
+    try:
+        while True:
+            skips = [skip + i * take for i in range(wave)]
+            pages = await asyncio.gather(*(fetch_page(s) for s in skips))
+            windows.pages += wave
+            
+            window_done = False
+            for records in pages:
+                buffer += serialize_jsonl(records)
+                buffer_count += len(records)
+                total += len(records)
+                
+                # Fecha um bloco do arquivo do período
+                if len(buffer) >= TARGET_PART_BYTES or buffer_count >= MAX_PART_RECORDS:
+                    add_block()
+                
+                if len(records) < take:
+                    window_done = True
+                    break
             
-            skip += take
+            if not window_done:
+                skip += take * wave
+                wave = min(wave * 2, PAGE_CONCURRENCY)
+                continue
             
-        except Exception as e:
-            print(f"[Worker {worker_id}] Erro em {start_date}: {e}")
-            time.sleep(5)
-            continue
-    
-    # Salva restante
+            # Janela esgotada: próxima sub-janela, skip do zero
+            if not windows.advance():
+                break
+            skip = 0
+            wave = 1
+            params["dateSaleStart"] = windows.start.isoformat()
+            params["dateSaleEnd"] = windows.end.isoformat()
+    except PeriodError as e:
+        return await abort(str(e))
+    
+    # Salva restante e publica o arquivo aberto
     if buffer:
-        part_num += 1
-        part_name = f"{prefix}part-{part_num:05d}.jsonl.gz"
-        
-        lines = [json.dumps(r, ensure_ascii=False, default=str) for r in buffer]
-        content = '\n'.join(lines).encode('utf-8')
-        compressed = gzip.compress(content)
-        
-        file_client = fs.get_file_client(f"{base_path}/{part_name}")
-        file_client.upload_data(compressed, overwrite=True)
-        
-        print(f"[Worker {worker_id}] {prefix}: {part_name} ({len(buffer):,} registros) - FINAL")
+        add_block(final=True)
+    elif period_file is not None:
+        pending.append(period_file.commit(uploader))
+    
+    # Aguarda os uploads e propaga a primeira falha
+    for future in pending:
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            if "base64" in str(e).lower():
+                return await abort(f"Azure Key inválida: {e}")
+            return await abort(f"Upload falhou: {e}")
     
     elapsed = time.time() - start_time
     
     return {
         "period": f"{start_date} - {end_date}",
         "records": total,
-        "parts": part_num,
+        "parts": files,
+        "blocks": blocks,
         "elapsed": elapsed,
-        "requests": rate_limiter.count,
+        "requests": requests_made,
         "worker_id": worker_id,
     }
 
 
+def add_months(d: date, months: int) -> date:
+    """Soma meses a uma data, limitando o dia ao fim do mês (como relativedelta)."""
+    index = d.year * 12 + d.month - 1 + months
+    year, month = divmod(index, 12)
+    month += 1
+    return d.replace(year=year, month=month, day=min(d.day, calendar.monthrange(year, month)[1]))
+
+
 def generate_periods(start_date: str, end_date: str) -> List[Tuple[str, str]]:
     """Gera lista de períodos mensais."""
-    from dateutil.relativedelta import relativedelta
-    
     periods = []
-    current = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
+    current = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
     
     while current < end:
-        period_end = current + relativedelta(months=1) - timedelta(days=1)
-        if period_end > end:
-            period_end = end
+        next_start = add_months(current, 1)
+        period_end = min(next_start - timedelta(days=1), end)
         
-        periods.append((current.strftime("%Y-%m-%d"), period_end.strftime("%Y-%m-%d")))
-        current = current + relativedelta(months=1)
+        periods.append((current.isoformat(), period_end.isoformat()))
+        current = next_start
     
     return periods
 
@@ -248,6 +637,7 @@ def main():
     parser.add_argument("--end-date", help="Data fim (YYYY-MM-DD)")
     parser.add_argument("--year", type=int, help="Extrair ano completo")
     parser.add_argument("--workers", type=int, default=4, help="Workers paralelos (default: 4)")
+    parser.add_argument("--rpm", type=int, help="Requests/min agregados na API (default: 40 por worker)")
     parser.add_argument("--no-receivables", action="store_true")
     args = parser.parse_args()
     
@@ -267,6 +657,8 @@ def main():
     print("="*60)
     print(f"Período: {start_date} a {end_date}")
     print(f"Workers: {args.workers}")
+    rpm = args.rpm or 40 * args.workers
+    print(f"Rate limit: {rpm} rpm (compartilhado)")
     print(f"Receivables: {not args.no_receivables}")
     
     # Gera períodos
@@ -278,46 +670,24 @@ def main():
     print(f"Run ID: {run_id}")
     print("="*60)
     
-    # Prepara args para workers
-    worker_args = [
-        (p[0], p[1], run_id, not args.no_receivables, i % args.workers)
-        for i, p in enumerate(periods)
-    ]
+    # Caminho da run calculado uma vez: todos os períodos e o manifest
+    # caem na mesma ingestion_date mesmo se a run cruzar a meia-noite
+    base_path = f"bronze/evo/entity=sales/ingestion_date={datetime.now(timezone.utc).strftime('%Y-%m-%d')}/run_id={run_id}"
     
-    # Executa em paralelo
+    # Executa: um processo, um event loop, clientes compartilhados
     start_time = time.time()
-    results = []
-    
-    with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        futures = {executor.submit(extract_period_worker, arg): arg for arg in worker_args}
-        
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                results.append(result)
-                
-                if "error" not in result:
-                    print(f"✓ {result['period']}: {result['records']:,} registros em {result['elapsed']:.0f}s")
-                else:
-                    print(f"✗ {result['period']}: {result['error']}")
-                    
-            except Exception as e:
-                print(f"✗ Erro: {e}")
+    fs = create_fs_client(ENV)  # reusado para o manifest
+    listener = start_log_listener(run_id)
+    try:
+        results = asyncio.run(run_periods(periods, base_path, not args.no_receivables, args.workers, rpm, ENV, fs))
+    finally:
+        listener.stop()
     
     total_elapsed = time.time() - start_time
     total_records = sum(r.get("records", 0) for r in results)
     total_parts = sum(r.get("parts", 0) for r in results)
     
     # Salva manifest
-    from azure.storage.filedatalake import DataLakeServiceClient
-    service = DataLakeServiceClient(
-        account_url=f"https://{ENV['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
-        credential=ENV["AZURE_STORAGE_ACCOUNT_KEY"]
-    )
-    fs = service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
-    
-    base_path = f"bronze/evo/entity=sales/ingestion_date={datetime.now(timezone.utc).strftime('%Y-%m-%d')}/run_id={run_id}"
-    
     manifest = {
         "entity": "sales",
         "mode": "full_parallel",
@@ -325,6 +695,7 @@ def main():
         "start_date": start_date,
         "end_date": end_date,
         "workers": args.workers,
+        "rpm": rpm,
         "total_records": total_records,
         "total_parts": total_parts,
         "total_elapsed_seconds": total_elapsed,
@@ -332,8 +703,11 @@ def main():
         "results": results,
     }
     
-    content = json.dumps(manifest, indent=2, ensure_ascii=False, default=str)
-    fs.get_file_client(f"{base_path}/_manifest.json").upload_data(content.encode('utf-8'), overwrite=True)
+    if orjson is not None:
+        content = orjson.dumps(manifest, default=str, option=orjson.OPT_INDENT_2)
+    else:
+        content = json.dumps(manifest, indent=2, default=str).encode('ascii')
+    _upload_chunked(fs, f"{base_path}/_manifest.json", content)
     
     # Resultado
     print()
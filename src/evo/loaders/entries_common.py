@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Peças comuns dos loaders de EVO Entries (v1 e v2).
+
+Metadados do path do bronze, parse do campo "date", entry_id determinístico,
+erros de failover e o formato binário do COPY em stg_evo.entries_raw.
+Importado pelos loaders como módulo irmão (rodam como script).
+"""
+import hashlib
+import logging
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+
+# Metadados do path do bronze
+RUN_ID_RE = re.compile(r"run_id=([^/]+)")
+INGESTION_DATE_RE = re.compile(r"ingestion_date=(\d{4}-\d{2}-\d{2})")
+
+
+# "date" da API: fromisoformat do Python 3.10 rejeita "Z" e frações que não
+# tenham 3 ou 6 dígitos; esses casos são normalizados antes de desistir
+ENTRY_DATE_RE = re.compile(
+    r"(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2})?)(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?"
+)
+
+
+def parse_entry_date(value) -> Optional[datetime]:
+    """datetime do campo "date"; None se não for uma data ISO reconhecível."""
+    text = str(value).strip()
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    m = ENTRY_DATE_RE.fullmatch(text)
+    if not m:
+        return None
+    base, frac, offset = m.groups()
+    if frac:
+        base += "." + frac[:6].ljust(6, "0")
+    if offset == "Z":
+        base += "+00:00"
+    elif offset:
+        base += offset if ":" in offset else f"{offset[:3]}:{offset[3:]}"
+    try:
+        return datetime.fromisoformat(base)
+    except ValueError:
+        return None
+
+
+# Failover do PostgreSQL: conexão caiu/recusada ou servidor virou read-only.
+# Outros erros (dados, SQL, bugs) falham na hora, sem retry.
+RETRYABLE_ERRORS = (
+    psycopg2.OperationalError,  # inclui AdminShutdown e CannotConnectNow
+    psycopg2.InterfaceError,    # connection already closed
+    psycopg2.errors.ReadOnlySqlTransaction,
+)
+
+
+# COPY binário (FORMAT BINARY): sem escaping no cliente nem parse de texto no servidor.
+# O payload vai descomprimido: COPY FROM PROGRAM exige superuser no host do
+# PostgreSQL (indisponível no gerenciado) e o libpq não comprime mais o TLS.
+# O entry_id é calculado no cliente, então o servidor não lê o bronze direto.
+COPY_COLUMNS = ('entry_id', 'entry_date', 'raw_data', '_source_file', 'run_id', 'ingestion_date', '_loaded_at')
+COPY_SQL = f"COPY tmp_entries ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+PG_EPOCH_DATE = PG_EPOCH.date()
+
+FIELD_LEN = struct.Struct(">i")
+ROW_TAIL = struct.Struct(">iiiq")    # ingestion_date, _loaded_at
+ONE_US = timedelta(microseconds=1)
+
+
+def pg_timestamp_us(dt: datetime) -> int:
+    """Microssegundos desde 2000-01-01 UTC (TIMESTAMPTZ binário)."""
+    return (dt - PG_EPOCH) // ONE_US
+
+
+def session_tzinfo(cur):
+    """TimeZone da sessão: é como o COPY texto interpretava datas sem offset."""
+    cur.execute("SHOW TimeZone")
+    name = cur.fetchone()[0]
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"TimeZone '{name}' desconhecido, usando UTC")
+        return timezone.utc
+
+
+ENTRY_ID_MOD = 10**15
+
+
+def generate_entry_ids_batch(records: List[Dict]) -> List[int]:
+    """entry_id determinístico (MD5 → 15 dígitos hex → BIGINT) para registros com "date".
+
+    Chave: date + idMember/idProspect/idEmployee + idBranch + device + entryAction.
+    Mesmo valor de int(md5.hexdigest()[:15], 16), sem hexdigest/int() por linha:
+    os 15 primeiros dígitos hex são os 60 bits altos dos 8 primeiros bytes.
+    """
+    keys = [
+        f"{r['date']!s}|{r.get('idMember') or ''!s}|{r.get('idProspect') or ''!s}"
+        f"|{r.get('idEmployee') or ''!s}|{r.get('idBranch') or ''!s}"
+        f"|{r.get('device') or ''!s}|{r.get('entryAction') or ''!s}"
+        for r in records
+    ]
+    # Um único encode para o lote; se algum campo tiver "\n", codifica chave a chave
+    blobs = "\n".join(keys).encode().split(b"\n")
+    if len(blobs) != len(keys):
+        blobs = [k.encode() for k in keys]
+    md5 = hashlib.md5
+    from_bytes = int.from_bytes
+    return [(from_bytes(md5(b).digest()[:8], "big") >> 4) % ENTRY_ID_MOD for b in blobs]
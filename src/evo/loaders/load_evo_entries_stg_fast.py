@@ -17,16 +17,29 @@ import io
 import json
 import logging
 import os
-import re
+import struct
 import sys
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from threading import Lock, local
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
 import psycopg2
 
+try:
+    import orjson
+except ImportError:  # fallback: json da stdlib
+    orjson = None
+
+from entries_common import (
+    COPY_HEADER, COPY_SQL, COPY_TRAILER, FIELD_LEN, INGESTION_DATE_RE, PG_EPOCH_DATE,
+    RETRYABLE_ERRORS, ROW_TAIL, RUN_ID_RE, generate_entry_ids_batch, parse_entry_date,
+    pg_timestamp_us, session_tzinfo,
+)
+
 # Silencia logs
 logging.getLogger("azure").setLevel(logging.WARNING)
 
@@ -36,6 +49,45 @@ LOG_DIR = PROJECT_ROOT / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 
 
+# Layout da linha no COPY binário (cabeçalho, colunas e formato em entries_common)
+_ROW_HEAD = struct.Struct(">hiqiq")   # nº de campos, entry_id, entry_date
+_JSONB_HEAD = struct.Struct(">ib")    # tamanho + versão do jsonb (1)
+
+
+def _binary_row(entry_id: int, entry_date_us: int, raw_json: bytes,
+                source: bytes, run_id: bytes, ing_date_days: int, loaded_at_us: int) -> Tuple[bytes, ...]:
+    """Pedaços de uma linha no formato binário do COPY (7 campos)."""
+    return (
+        _ROW_HEAD.pack(7, 8, entry_id, 8, entry_date_us),
+        _JSONB_HEAD.pack(len(raw_json) + 1, 1),
+        raw_json,
+        FIELD_LEN.pack(len(source)),
+        source,
+        FIELD_LEN.pack(len(run_id)),
+        run_id,
+        ROW_TAIL.pack(4, ing_date_days, 8, loaded_at_us),
+    )
+
+
+def iter_gzip_jsonl(compressed: bytes):
+    """Descompacta e parseia o JSONL em streaming, linha a linha (bytes, sem decode)."""
+    loads = orjson.loads if orjson is not None else json.loads
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as gz:
+        for line in gz:
+            if line.strip():
+                yield loads(line)
+
+
+if orjson is not None:
+    def dumps_raw(rec: Dict) -> bytes:
+        """JSON UTF-8 do registro para a coluna raw_data."""
+        return orjson.dumps(rec, default=str, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps_raw(rec: Dict) -> bytes:
+        """JSON UTF-8 do registro para a coluna raw_data."""
+        return json.dumps(rec, ensure_ascii=False, default=str).encode()
+
+
 def load_env():
     env_paths = [
         PROJECT_ROOT / "config" / ".env",
@@ -109,19 +161,16 @@ class SimpleLakeClient:
         )
         self.fs = self.service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
     
-    def list_paths(self, path: str) -> List[str]:
-        paths = []
+    def list_paths(self, path: str) -> Iterator[str]:
+        """Parts na ordem da listagem, conforme chegam as páginas (sem ordenar)."""
         for item in self.fs.get_paths(path=path, recursive=True):
             if not item.is_directory and item.name.endswith('.jsonl.gz'):
-                paths.append(item.name)
-        return sorted(paths)
+                yield item.name
     
     def read_gzip_jsonl(self, path: str) -> List[Dict]:
         file_client = self.fs.get_file_client(path)
         compressed = file_client.download_file().readall()
-        decompressed = gzip.decompress(compressed)
-        lines = decompressed.decode('utf-8').strip().split('\n')
-        return [json.loads(line) for line in lines if line.strip()]
+        return list(iter_gzip_jsonl(compressed))
 
 
 class FastEntriesLoader:
@@ -129,73 +178,93 @@ class FastEntriesLoader:
         self.lake = SimpleLakeClient()
         self.workers = workers
         self.base_path = "bronze/evo/entity=entries"
+        # Uma conexão por thread, reusada entre parts (fechadas no fim do run)
+        self._local = local()
+        self._conns = []
+        self._conns_lock = Lock()
+        self._session_tz = WeakKeyDictionary()
     
     def get_pg_connection(self):
-        return psycopg2.connect(
-            host=ENV["PG_HOST"], port=ENV["PG_PORT"], database=ENV["PG_DATABASE"],
-            user=ENV["PG_USER"], password=ENV["PG_PASSWORD"], sslmode=ENV["PG_SSLMODE"]
-        )
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = psycopg2.connect(
+                host=ENV["PG_HOST"], port=ENV["PG_PORT"], database=ENV["PG_DATABASE"],
+                user=ENV["PG_USER"], password=ENV["PG_PASSWORD"], sslmode=ENV["PG_SSLMODE"]
+            )
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+    
+    def session_tz(self, conn):
+        """TimeZone da sessão, lido uma vez por conexão (não a cada part)."""
+        tz = self._session_tz.get(conn)
+        if tz is None:
+            with conn.cursor() as cur:
+                tz = self._session_tz[conn] = session_tzinfo(cur)
+        return tz
     
     def find_all_run_ids(self) -> List[str]:
         paths = self.lake.list_paths(self.base_path)
         run_ids = set()
         for p in paths:
-            match = re.search(r"run_id=([^/]+)", p)
+            match = RUN_ID_RE.search(p)
             if match:
                 run_ids.add(match.group(1))
         return sorted(run_ids)
     
-    def list_all_parts(self) -> List[str]:
+    def list_all_parts(self) -> Iterator[str]:
         return self.lake.list_paths(self.base_path)
     
-    def list_parts(self, run_id: str) -> List[str]:
+    def list_parts(self, run_id: str) -> Iterator[str]:
         paths = self.lake.list_paths(self.base_path)
-        return [p for p in paths if f"run_id={run_id}" in p]
+        return (p for p in paths if f"run_id={run_id}" in p)
     
     def extract_metadata(self, path: str) -> Tuple[str, str]:
-        run_match = re.search(r"run_id=([^/]+)", path)
-        date_match = re.search(r"ingestion_date=(\d{4}-\d{2}-\d{2})", path)
+        run_match = RUN_ID_RE.search(path)
+        date_match = INGESTION_DATE_RE.search(path)
         run_id = run_match.group(1) if run_match else "unknown"
         ing_date = date_match.group(1) if date_match else datetime.now().strftime("%Y-%m-%d")
         return run_id, ing_date
     
-    def prepare_copy_data(self, records: List[Dict], source_file: str) -> io.StringIO:
-        """Prepara dados para COPY. Cria entry_id determinístico via MD5."""
-        import hashlib
-        
-        buffer = io.StringIO()
-        now = datetime.now(timezone.utc).isoformat()
+    def prepare_copy_data(self, records: List[Dict], source_file: str, tz=timezone.utc) -> io.BytesIO:
+        """Prepara dados para COPY binário. Cria entry_id determinístico via MD5."""
+        # Pedaços numa lista e um único join no fim: o payload é alocado uma
+        # vez no tamanho exato, sem realocações de um BytesIO crescendo
+        chunks = [COPY_HEADER]
+        now_us = pg_timestamp_us(datetime.now(timezone.utc))
         run_id, ing_date = self.extract_metadata(source_file)
+        source_b = source_file.encode()
+        run_id_b = run_id.encode()
+        ing_days = (date.fromisoformat(ing_date) - PG_EPOCH_DATE).days
         
-        for rec in records:
-            entry_date = rec.get("date")
-            if not entry_date:
+        records = [rec for rec in records if rec.get("date")]
+        entry_ids = generate_entry_ids_batch(records)
+        
+        # Dedup por (entry_id, entry_date), última ocorrência vence: o
+        # ON CONFLICT DO UPDATE não aceita a mesma chave duas vezes no INSERT
+        unique = {}
+        invalid = 0
+        for rec, entry_id in zip(records, entry_ids):
+            # Datas sem offset seguem o TimeZone da sessão (como no COPY texto)
+            dt = parse_entry_date(rec["date"])
+            if dt is None:
+                invalid += 1
                 continue
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=tz)
             
-            # Chave determinística: MD5 de campos que identificam a entrada
-            # date + idMember/idProspect/idEmployee + idBranch + device + entryAction
-            key_parts = [
-                str(entry_date),
-                str(rec.get("idMember") or ""),
-                str(rec.get("idProspect") or ""),
-                str(rec.get("idEmployee") or ""),
-                str(rec.get("idBranch") or ""),
-                str(rec.get("device") or ""),
-                str(rec.get("entryAction") or ""),
-            ]
-            key_str = "|".join(key_parts)
-            
-            # MD5 -> primeiros 15 dígitos como BIGINT
-            md5_hash = hashlib.md5(key_str.encode()).hexdigest()
-            entry_id = int(md5_hash[:15], 16) % (10**15)
-            
-            raw_json = json.dumps(rec, ensure_ascii=False, default=str)
-            raw_json = raw_json.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
-            
-            buffer.write(f"{entry_id}\t{entry_date}\t{raw_json}\t{source_file}\t{run_id}\t{ing_date}\t{now}\n")
+            unique[(entry_id, pg_timestamp_us(dt))] = rec
         
-        buffer.seek(0)
-        return buffer
+        if invalid:
+            logger.warning(f"{source_file}: {invalid} registro(s) com date inválida ignorado(s)")
+        
+        for (entry_id, entry_date_us), rec in unique.items():
+            chunks += _binary_row(entry_id, entry_date_us, dumps_raw(rec),
+                                  source_b, run_id_b, ing_days, now_us)
+        
+        chunks.append(COPY_TRAILER)
+        # BytesIO sobre bytes compartilha o buffer (sem cópia)
+        return io.BytesIO(b"".join(chunks))
     
     def load_batch_with_copy(self, conn, records: List[Dict], source_file: str) -> int:
         if not records:
@@ -216,9 +285,8 @@ class FastEntriesLoader:
             """)
             cur.execute("TRUNCATE tmp_entries")
             
-            buffer = self.prepare_copy_data(records, source_file)
-            cur.copy_from(buffer, 'tmp_entries', sep='\t',
-                         columns=('entry_id', 'entry_date', 'raw_data', '_source_file', 'run_id', 'ingestion_date', '_loaded_at'))
+            buffer = self.prepare_copy_data(records, source_file, self.session_tz(conn))
+            cur.copy_expert(COPY_SQL, buffer)
             
             # INSERT com ON CONFLICT (tabela particionada)
             cur.execute("""
@@ -252,31 +320,19 @@ class FastEntriesLoader:
                 conn = self.get_pg_connection()
                 try:
                     count = self.load_batch_with_copy(conn, records, part_path)
-                finally:
+                except RETRYABLE_ERRORS:
+                    # Após failover a conexão pode seguir viva no servidor antigo: reabre
                     conn.close()
+                    raise
                 elapsed = (datetime.now() - start).total_seconds()
                 return part_path, count, elapsed
                 
-            except Exception as e:
-                error_msg = str(e).lower()
-                
-                # Detecta erros de failover/read-only
-                is_failover = any(x in error_msg for x in [
-                    'read-only',
-                    'readonly', 
-                    'connection already closed',
-                    'adminshutdown',
-                    'server closed the connection',
-                    'terminating connection'
-                ])
-                
-                if is_failover and attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)  # Exponential backoff: 30, 60, 120, 240s
-                    logger.warning(f"⚠️ Failover detectado em {Path(part_path).name}, aguardando {delay}s... (tentativa {attempt + 1}/{max_retries})")
-                    time.sleep(delay)
-                    continue
-                else:
+            except RETRYABLE_ERRORS:
+                if attempt == max_retries - 1:
                     raise
+                delay = base_delay * (2 ** attempt)  # Exponential backoff: 30, 60, 120, 240s
+                logger.warning(f"⚠️ Failover detectado em {Path(part_path).name}, aguardando {delay}s... (tentativa {attempt + 1}/{max_retries})")
+                time.sleep(delay)
         return part_path, count, elapsed
     
     def run(self, run_id: Optional[str] = None, all_runs: bool = False) -> Dict[str, Any]:
@@ -299,30 +355,36 @@ class FastEntriesLoader:
             logger.info(f"Run ID mais recente: {run_id}")
             parts = self.list_parts(run_id)
         
-        logger.info(f"Parts: {len(parts)}")
-        
-        if not parts:
-            return {"error": "No parts found"}
-        
         total_records = 0
         processed = 0
         errors = 0
         start_time = datetime.now()
         
         with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            futures = {executor.submit(self.process_part, p): p for p in parts}
+            # Submete conforme a listagem pagina: o primeiro COPY começa sem
+            # esperar a enumeração completa
+            futures = [executor.submit(self.process_part, p) for p in parts]
+            logger.info(f"Parts: {len(futures)}")
+            
+            if not futures:
+                return {"error": "No parts found"}
+            
             for future in as_completed(futures):
                 try:
                     path, count, elapsed = future.result()
                     total_records += count
                     processed += 1
-                    if processed % 100 == 0 or processed == len(parts):
-                        logger.info(f"  [{processed}/{len(parts)}] {total_records:,} entries carregados")
+                    if processed % 100 == 0 or processed == len(futures):
+                        logger.info(f"  [{processed}/{len(futures)}] {total_records:,} entries carregados")
                 except Exception as e:
                     errors += 1
                     logger.error(f"Erro: {e}")
         
         total_elapsed = (datetime.now() - start_time).total_seconds()
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
         
         logger.info("="*60)
         logger.info(f"Total: {total_records:,} em {total_elapsed:.1f}s ({total_records/total_elapsed:,.0f}/s)")
@@ -4,42 +4,96 @@ Loader OTIMIZADO v2: EVO Entries Bronze → STG
 
 OTIMIZADO PARA ALTO VOLUME (~110M registros):
 1. ThreadedConnectionPool
-2. Batch de múltiplos parts
+2. Batches de múltiplos parts por tamanho (pipeline leitura → COPY)
 3. Streaming decompress
 4. Particionamento por ano
 
 Uso:
     cd C:/skyfit-datalake/evo_entries
-    python src/loaders/load_evo_entries_stg_fast_v2.py --workers 8 --batch-size 10 --all-runs
+    python src/loaders/load_evo_entries_stg_fast_v2.py --workers 8 --batch-bytes 8388608 --all-runs
 """
 import argparse
 import gzip
-import hashlib
 import io
 import json
 import logging
 import os
+import queue
 import re
+import sqlite3
+import struct
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from bisect import bisect_right
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
 from threading import Lock
 from typing import Any, Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
 import psycopg2
 from psycopg2 import pool
 
+try:
+    import orjson
+except ImportError:  # fallback: json da stdlib
+    orjson = None
+
+from entries_common import (
+    COPY_COLUMNS, COPY_HEADER, COPY_SQL, COPY_TRAILER, FIELD_LEN, INGESTION_DATE_RE, ONE_US,
+    PG_EPOCH, PG_EPOCH_DATE, RETRYABLE_ERRORS, ROW_TAIL, RUN_ID_RE, generate_entry_ids_batch,
+    parse_entry_date, pg_timestamp_us, session_tzinfo,
+)
+
 SCRIPT_DIR = Path(__file__).parent.resolve()
 PROJECT_ROOT = SCRIPT_DIR.parent.parent
 LOG_DIR = PROJECT_ROOT / "logs"
 LOG_DIR.mkdir(exist_ok=True)
+# Índice local da listagem do lake (apagar força relistagem completa)
+PATH_INDEX_FILE = PROJECT_ROOT / ".cache" / "lake_paths.sqlite"
 
 logging.getLogger("azure").setLevel(logging.WARNING)
 
 
+# COPY direto na partição folha (mesmas colunas do COPY_SQL de entries_common)
+COPY_DIRECT_SQL = f"COPY {{target}} ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+_ROW_PREFIX = struct.Struct(">hiqiqib")  # nº de campos, entry_id, entry_date, tamanho + versão do jsonb (1)
+
+
+# Batches por tamanho comprimido (parts ~10k entries ≈ 0.5 MB; o final do período é menor)
+BATCH_BYTES = 8 * 1024 * 1024
+BATCH_MAX_PARTS = 50
+
+# Downloads simultâneos de parts (pool do lake) e range-reads por blob
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_RANGE_CONCURRENCY = 4
+
+
+def _row_suffix(source: bytes, run_id: bytes, ing_date_days: int, loaded_at_us: int) -> bytes:
+    """Campos finais da linha do COPY binário, constantes por part."""
+    return (FIELD_LEN.pack(len(source)) + source + FIELD_LEN.pack(len(run_id)) + run_id
+            + ROW_TAIL.pack(4, ing_date_days, 8, loaded_at_us))
+
+
+def iter_gzip_jsonl(compressed: bytes):
+    """
+    Descompacta e parseia o JSONL em streaming, linha a linha (bytes, sem decode).
+    
+    Produz (linha, registro): a linha original vai direto para raw_data, sem
+    reserializar o dict.
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as gz:
+        for line in gz:
+            line = line.rstrip(b"\r\n")
+            if line.strip():
+                yield line, loads(line)
+
+
 def load_env():
     env_paths = [
         PROJECT_ROOT / "config" / ".env",
@@ -86,16 +140,135 @@ def validate_env():
 
 validate_env()
 
-log_file = LOG_DIR / f"load_entries_v2_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s | %(levelname)-8s | %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[logging.StreamHandler(), logging.FileHandler(log_file, encoding='utf-8')]
-)
 logger = logging.getLogger(__name__)
 
 
+def setup_logging():
+    """Só no processo principal: os processos de parse não abrem arquivo de log."""
+    log_file = LOG_DIR / f"load_entries_v2_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s | %(levelname)-8s | %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        handlers=[logging.StreamHandler(), logging.FileHandler(log_file, encoding='utf-8')]
+    )
+
+
+# Etapa CPU (parse + montagem do COPY) roda em processos: fora do GIL dos
+# workers de COPY. Funções de módulo para serem picklable.
+
+@lru_cache(maxsize=None)
+def _run_metadata(run_dir: str) -> Tuple[str, str]:
+    run_match = RUN_ID_RE.search(run_dir)
+    date_match = INGESTION_DATE_RE.search(run_dir)
+    run_id = run_match.group(1) if run_match else "unknown"
+    ing_date = date_match.group(1) if date_match else datetime.now().strftime("%Y-%m-%d")
+    return run_id, ing_date
+
+
+def extract_metadata(path: str) -> Tuple[str, str]:
+    # Metadados são do diretório do run: parse uma vez por diretório
+    return _run_metadata(os.path.dirname(path))
+
+
+def prepare_batch_copy_data(parts_data: List[Tuple[str, List[Tuple[bytes, Dict]]]],
+                            tz=timezone.utc) -> Tuple[Dict[int, bytes], Dict[str, int]]:
+    """COPY binário do batch por ano, sem duplicatas de (entry_id, entry_date).
+
+    Montado por colunas (ids, datas, JSON) com compreensões, e não campo a
+    campo por registro. Um payload por ano (no TimeZone da sessão, como as
+    partições), para COPY direto na partição folha.
+    
+    Devolve também os registros ignorados por date inválida, por part: roda
+    no processo filho (sem o log do run), então quem registra é o pai.
+    """
+    now_us = pg_timestamp_us(datetime.now(timezone.utc))
+    # Última ocorrência vence, como no ON CONFLICT DO UPDATE
+    rows = {}
+    invalid: Dict[str, int] = {}
+    
+    for source_file, records in parts_data:
+        run_id, ing_date = extract_metadata(source_file)
+        ing_days = (date.fromisoformat(ing_date) - PG_EPOCH_DATE).days
+        suffix = _row_suffix(source_file.encode(), run_id.encode(), ing_days, now_us)
+        
+        records = [(line, rec) for line, rec in records if rec.get("date")]
+        # Datas sem offset seguem o TimeZone da sessão (como no COPY texto)
+        dates = [parse_entry_date(rec["date"]) for _, rec in records]
+        if None in dates:
+            # Uma data inválida não derruba o batch: a linha é ignorada
+            invalid[source_file] = dates.count(None)
+            records = [r for r, dt in zip(records, dates) if dt is not None]
+            dates = [dt for dt in dates if dt is not None]
+        entry_ids = generate_entry_ids_batch([rec for _, rec in records])
+        dates_us = [
+            (dt - PG_EPOCH if dt.tzinfo else dt.replace(tzinfo=tz) - PG_EPOCH) // ONE_US
+            for dt in dates
+        ]
+        # raw_data = linha original do bronze (JSON válido), sem json.dumps
+        rows.update(zip(zip(entry_ids, dates_us), zip((line for line, _ in records), repeat(suffix))))
+    
+    if not rows:
+        return {}, invalid
+    
+    # Ano de cada linha por busca nas viradas de ano entre os extremos do batch
+    dates_us = [key[1] for key in rows]
+    first_year = (PG_EPOCH + min(dates_us) * ONE_US).astimezone(tz).year
+    last_year = (PG_EPOCH + max(dates_us) * ONE_US).astimezone(tz).year
+    year_starts = [pg_timestamp_us(datetime(y, 1, 1, tzinfo=tz)) for y in range(first_year + 1, last_year + 1)]
+    
+    # Esquema fixo já especializado à mão: por linha, um pack (campos fixos)
+    # + JSON + sufixo pré-montado do part. Codegen em runtime geraria o mesmo.
+    pack = _ROW_PREFIX.pack
+    by_year: Dict[int, List[bytes]] = {}
+    for (entry_id, entry_date_us), (raw_json, suffix) in rows.items():
+        year = first_year + bisect_right(year_starts, entry_date_us)
+        chunks = by_year.get(year) or by_year.setdefault(year, [COPY_HEADER])
+        chunks += (pack(7, 8, entry_id, 8, entry_date_us, len(raw_json) + 1, 1), raw_json, suffix)
+    
+    # Trailer entra no join: um payload alocado uma vez, sem "+" copiando tudo de novo
+    for chunks in by_year.values():
+        chunks.append(COPY_TRAILER)
+    return {year: b"".join(chunks) for year, chunks in by_year.items()}, invalid
+
+
+def prepare_batch_payload(parts: List[Tuple[str, bytes]], tz) -> Tuple[Dict[int, bytes], Dict[str, float], Dict[str, int]]:
+    """Descompacta/parseia os parts e devolve os payloads do COPY binário por ano (roda no processo filho)."""
+    t0 = time.time()
+    parts_data = [(path, list(iter_gzip_jsonl(compressed))) for path, compressed in parts]
+    t1 = time.time()
+    payloads, invalid = prepare_batch_copy_data(parts_data, tz)
+    return payloads, {'parse': t1 - t0, 'prepare': time.time() - t1}, invalid
+
+
+# Preparados uma vez por conexão do pool (ver ConnectionPoolManager.get_connection)
+TMP_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS tmp_entries (
+        entry_id BIGINT,
+        entry_date TIMESTAMPTZ,
+        raw_data JSONB,
+        _source_file TEXT,
+        run_id TEXT,
+        ingestion_date DATE,
+        _loaded_at TIMESTAMPTZ
+    ) ON COMMIT DELETE ROWS
+"""
+PREPARE_INSERT_SQL = """
+    PREPARE ins_entries AS
+    INSERT INTO stg_evo.entries_raw (entry_id, entry_date, raw_data, _source_file, run_id, ingestion_date, _loaded_at)
+    SELECT entry_id, entry_date, raw_data, _source_file, run_id, ingestion_date, _loaded_at
+    FROM tmp_entries
+    ON CONFLICT (entry_id, entry_date) DO UPDATE SET
+        raw_data = EXCLUDED.raw_data,
+        _source_file = EXCLUDED._source_file,
+        run_id = EXCLUDED.run_id
+"""
+# Commit sem esperar o fsync do WAL: o COPY não fica preso na latência do
+# disco a cada batch. Um crash perde só os últimos commits (nunca corrompe),
+# e o bronze é reprocessável com upsert idempotente.
+SYNCHRONOUS_COMMIT_SQL = "SET synchronous_commit = off"
+
+
 class ConnectionPoolManager:
     _instance = None
     _lock = Lock()
@@ -106,6 +279,7 @@ class ConnectionPoolManager:
                 cls._instance = super().__new__(cls)
                 cls._instance._pool = None
                 cls._instance._initialized = False
+                cls._instance._session_tz = WeakKeyDictionary()
             return cls._instance
     
     def initialize(self, min_conn: int = 2, max_conn: int = 10):
@@ -121,10 +295,37 @@ class ConnectionPoolManager:
     @contextmanager
     def get_connection(self):
         conn = self._pool.getconn()
+        discard = False
         try:
+            if conn not in self._session_tz:
+                self._setup_session(conn)
             yield conn
+        except RETRYABLE_ERRORS:
+            # Após failover a conexão pode seguir viva no servidor antigo (read-only)
+            discard = True
+            raise
         finally:
-            self._pool.putconn(conn)
+            self._pool.putconn(conn, close=discard)
+    
+    def _setup_session(self, conn):
+        """
+        synchronous_commit, temp table, INSERT preparado e TimeZone ficam na
+        sessão; depois a conexão passa a autocommit (o COPY direto vira um
+        único round-trip).
+        """
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            cur.execute(SYNCHRONOUS_COMMIT_SQL)
+            cur.execute(TMP_TABLE_SQL)
+            cur.execute("DEALLOCATE ALL")  # setup repetido após falha parcial
+            cur.execute(PREPARE_INSERT_SQL)
+            tz = session_tzinfo(cur)
+        conn.commit()
+        conn.autocommit = True
+        self._session_tz[conn] = tz
+    
+    def session_tz(self, conn):
+        return self._session_tz[conn]
     
     def close_all(self):
         if self._pool:
@@ -133,7 +334,7 @@ class ConnectionPoolManager:
 
 
 class OptimizedLakeClient:
-    def __init__(self):
+    def __init__(self, download_workers: int = DOWNLOAD_WORKERS, refresh_index: bool = False):
         from azure.storage.filedatalake import DataLakeServiceClient
         self.service = DataLakeServiceClient(
             account_url=f"https://{ENV['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
@@ -141,193 +342,260 @@ class OptimizedLakeClient:
         )
         self.fs = self.service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
         self._path_cache = {}
+        self._sizes: Dict[str, int] = {}
+        self.refresh_index = refresh_index  # descarta o índice em disco e relista tudo
+        # Pool compartilhado pelos workers: downloads dos parts em paralelo
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers)
+    
+    def download(self, path: str) -> bytes:
+        file_client = self.fs.get_file_client(path)
+        return file_client.download_file(max_concurrency=DOWNLOAD_RANGE_CONCURRENCY).readall()
+    
+    def close(self):
+        self._downloads.shutdown(wait=False)
     
-    def list_paths(self, prefix: str) -> List[str]:
+    def list_paths(self, prefix: str) -> Tuple[str, ...]:
         if prefix not in self._path_cache:
-            paths = []
-            for item in self.fs.get_paths(path=prefix, recursive=True):
-                if not item.is_directory and item.name.endswith('.jsonl.gz'):
-                    paths.append(item.name)
-            self._path_cache[prefix] = sorted(paths)
+            self._path_cache[prefix] = self._refresh_index(prefix)
         return self._path_cache[prefix]
     
-    def read_multiple_parts(self, paths: List[str]) -> Tuple[List[Tuple[str, List[Dict]]], Dict[str, float]]:
-        all_records = []
-        total_timings = {'download': 0, 'decompress': 0, 'parse': 0}
+    def _list_dirs(self, path: str) -> List[str]:
+        # Sem ordenar: o filtro de stale é por comparação, não por posição
+        return [item.name for item in self.fs.get_paths(path=path, recursive=False) if item.is_directory]
+    
+    def _list_run(self, run_dir: str) -> Tuple[List[Tuple[str, int]], bool]:
+        """Parts (path, tamanho) do run e se ele está completo (_manifest.json gravado)."""
+        parts, complete = [], False
+        for item in self.fs.get_paths(path=run_dir, recursive=True):
+            if item.is_directory:
+                continue
+            if item.name.endswith('.jsonl.gz'):
+                parts.append((item.name, item.content_length))
+            elif item.name == f"{run_dir}/_manifest.json":
+                complete = True
+        return parts, complete
+    
+    def part_size(self, path: str) -> int:
+        """Tamanho comprimido do part (bytes), conforme a listagem."""
+        return self._sizes.get(path, 0)
+    
+    def _refresh_index(self, prefix: str) -> Tuple[str, ...]:
+        """
+        Lista os parts de prefix/ingestion_date=*/run_id=* usando o índice em disco.
         
-        for path in paths:
-            t0 = time.time()
-            file_client = self.fs.get_file_client(path)
-            compressed = file_client.download_file().readall()
-            total_timings['download'] += time.time() - t0
-            
-            t0 = time.time()
-            decompressed = gzip.decompress(compressed)
-            total_timings['decompress'] += time.time() - t0
+        Um run só é congelado no índice depois que o extrator grava o
+        _manifest.json: runs ainda sem manifest (em gravação ou interrompidos)
+        são relistados a cada execução, junto com os runs novos.
+        """
+        prefix = prefix.rstrip("/")
+        PATH_INDEX_FILE.parent.mkdir(exist_ok=True)
+        db = sqlite3.connect(PATH_INDEX_FILE)
+        try:
+            columns = {row[1] for row in db.execute("PRAGMA table_info(parts)")}
+            if self.refresh_index or (columns and "size" not in columns):
+                # --refresh-index ou índice antigo, sem tamanho: relista tudo
+                db.execute("DROP TABLE IF EXISTS parts")
+                db.execute("DROP TABLE IF EXISTS runs")
+            db.execute("CREATE TABLE IF NOT EXISTS parts (run_dir TEXT NOT NULL, path TEXT PRIMARY KEY, size INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS runs (run_dir TEXT PRIMARY KEY, complete INTEGER NOT NULL)")
+            match = (len(prefix) + 1, prefix + "/")
+            runs = dict(db.execute(
+                "SELECT run_dir, complete FROM runs WHERE substr(run_dir, 1, ?) = ?", match))
+            complete = {run_dir for run_dir, done in runs.items() if done}
+            # Runs só em parts (índice de antes da tabela runs) contam como abertos
+            open_runs = {row[0] for row in db.execute(
+                "SELECT DISTINCT run_dir FROM parts WHERE substr(run_dir, 1, ?) = ?", match)}
+            open_runs = (open_runs | runs.keys()) - complete
+            # Só as ingestion_dates a partir do run aberto mais antigo (ou do
+            # último completo): as anteriores já estão congeladas
+            since = min(open_runs, default=max(complete, default="")).rsplit("/", 1)[0]
             
-            t0 = time.time()
-            lines = decompressed.decode('utf-8').strip().split('\n')
-            records = [json.loads(line) for line in lines if line.strip()]
-            total_timings['parse'] += time.time() - t0
+            stale = [
+                run_dir
+                for date_dir in self._list_dirs(prefix) if date_dir >= since
+                for run_dir in self._list_dirs(date_dir)
+                if run_dir not in complete
+            ]
+            for run_dir in stale:
+                parts, run_complete = self._list_run(run_dir)
+                db.execute("DELETE FROM parts WHERE run_dir = ?", (run_dir,))
+                db.executemany("INSERT OR REPLACE INTO parts VALUES (?, ?, ?)",
+                               [(run_dir, p, size) for p, size in parts])
+                db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)", (run_dir, run_complete))
+            db.commit()
+            logger.info(f"[LAKE] Índice: {len(complete)} runs completos em cache, {len(stale)} relistados")
             
-            all_records.append((path, records))
-        
-        return all_records, total_timings
+            # ORDER BY na PK (sem sort): batches agrupam parts do mesmo run
+            rows = db.execute(
+                "SELECT path, size FROM parts WHERE substr(run_dir, 1, ?) = ? ORDER BY path", match).fetchall()
+            self._sizes.update(rows)
+            return tuple(path for path, _ in rows)
+        finally:
+            db.close()
+    
+    def download_parts(self, paths: List[str]) -> Tuple[List[Tuple[str, bytes]], float]:
+        """Baixa os parts do batch em paralelo; devolve (path, bytes comprimidos) e o tempo."""
+        t0 = time.time()
+        futures = [self._downloads.submit(self.download, path) for path in paths]
+        parts = [(path, future.result()) for path, future in zip(paths, futures)]
+        return parts, time.time() - t0
 
 
 class FastEntriesLoaderV2:
-    def __init__(self, workers: int = 8, batch_size: int = 10):
-        self.lake = OptimizedLakeClient()
+    def __init__(self, workers: int = 8, batch_size: int = BATCH_MAX_PARTS,
+                 batch_bytes: int = BATCH_BYTES, cpu_workers: Optional[int] = None,
+                 refresh_index: bool = False):
+        self.lake = OptimizedLakeClient(refresh_index=refresh_index)
         self.workers = workers
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
         self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
         self.base_path = "bronze/evo/entity=entries"
         
         self.pool_manager = ConnectionPoolManager()
-        self.pool_manager.initialize(min_conn=2, max_conn=workers + 2)
+        # COPYs concorrentes na mesma tabela não se bloqueiam (sem LOCK TABLE
+        # nem advisory lock); folga para repor conexões descartadas em failover
+        self.pool_manager.initialize(min_conn=2, max_conn=2 * workers)
         
-        self.metrics = {'total_download': 0, 'total_decompress': 0, 'total_parse': 0, 'total_copy': 0}
+        self.metrics = {'total_download': 0, 'total_parse': 0, 'total_prepare': 0, 'total_copy': 0,
+                        'invalid_dates': 0}
         self.metrics_lock = Lock()
+        # Anos com COPY direto na partição folha: decidido no início do run
+        # (partição existe e está vazia) e desligado no primeiro conflito
+        self._direct_years = set()
+    
+    def pack_batches(self, parts: List[str]) -> List[List[str]]:
+        """Agrupa parts (em ordem) em batches de ~batch_bytes comprimidos, até batch_size parts."""
+        batches = []
+        current, current_bytes = [], 0
+        for path in parts:
+            size = self.lake.part_size(path)
+            if current and (current_bytes + size > self.batch_bytes or len(current) >= self.batch_size):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(path)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
     
     def find_all_run_ids(self) -> List[str]:
         paths = self.lake.list_paths(self.base_path)
         run_ids = set()
         for p in paths:
-            match = re.search(r"run_id=([^/]+)", p)
+            match = RUN_ID_RE.search(p)
             if match:
                 run_ids.add(match.group(1))
         return sorted(run_ids)
     
-    def list_all_parts(self) -> List[str]:
+    def list_all_parts(self) -> Tuple[str, ...]:
         return self.lake.list_paths(self.base_path)
     
-    def extract_metadata(self, path: str) -> Tuple[str, str]:
-        run_match = re.search(r"run_id=([^/]+)", path)
-        date_match = re.search(r"ingestion_date=(\d{4}-\d{2}-\d{2})", path)
-        run_id = run_match.group(1) if run_match else "unknown"
-        ing_date = date_match.group(1) if date_match else datetime.now().strftime("%Y-%m-%d")
-        return run_id, ing_date
+    def read_batch(self, part_paths: List[str], cpu: ProcessPoolExecutor,
+                   tz) -> Tuple[Dict[int, bytes], Dict[str, float], Dict[str, int]]:
+        """Download (threads) + parse/montagem do COPY (processo)."""
+        parts, download_time = self.lake.download_parts(part_paths)
+        payloads, timings, invalid = cpu.submit(prepare_batch_payload, parts, tz).result()
+        return payloads, {'download': download_time, **timings}, invalid
     
-    def generate_entry_id(self, rec: Dict) -> int:
-        """Gera entry_id determinístico via MD5."""
-        key_parts = [
-            str(rec.get("date", "")),
-            str(rec.get("idMember") or ""),
-            str(rec.get("idProspect") or ""),
-            str(rec.get("idEmployee") or ""),
-            str(rec.get("idBranch") or ""),
-            str(rec.get("device") or ""),
-            str(rec.get("entryAction") or ""),
-        ]
-        key_str = "|".join(key_parts)
-        md5_hash = hashlib.md5(key_str.encode()).hexdigest()
-        return int(md5_hash[:15], 16) % (10**15)
+    def load_batch_with_copy(self, conn, payloads: Dict[int, bytes]) -> Tuple[int, float]:
+        """Um COPY por ano, direto na partição folha (sem roteamento de tuplas)."""
+        t0 = time.time()
+        count = 0
+        with conn.cursor() as cur:
+            for year, payload in payloads.items():
+                count += self._copy_year(conn, cur, year, payload)
+        return count, time.time() - t0
     
-    def prepare_batch_copy_data(self, parts_data: List[Tuple[str, List[Dict]]]) -> io.StringIO:
-        buffer = io.StringIO()
-        now = datetime.now(timezone.utc).isoformat()
-        
-        for source_file, records in parts_data:
-            run_id, ing_date = self.extract_metadata(source_file)
-            
-            for rec in records:
-                entry_date = rec.get("date")
-                if not entry_date:
+    def find_direct_years(self, conn) -> set:
+        """Anos cuja partição folha existe e está vazia: só neles o COPY direto não conflita."""
+        years = set()
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'stg_evo.entries_raw'::regclass
+            """)
+            for (name,) in cur.fetchall():
+                match = re.fullmatch(r"entries_raw_(\d{4})", name)
+                if not match:
                     continue
-                
-                entry_id = self.generate_entry_id(rec)
-                
-                raw_json = json.dumps(rec, ensure_ascii=False, default=str)
-                raw_json = raw_json.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
-                
-                buffer.write(f"{entry_id}\t{entry_date}\t{raw_json}\t{source_file}\t{run_id}\t{ing_date}\t{now}\n")
-        
-        buffer.seek(0)
-        return buffer
+                cur.execute(f"SELECT NOT EXISTS (SELECT 1 FROM stg_evo.{name})")
+                if cur.fetchone()[0]:
+                    years.add(int(match.group(1)))
+        return years
     
-    def load_batch_with_copy(self, conn, parts_data: List[Tuple[str, List[Dict]]]) -> Tuple[int, float]:
-        if not parts_data:
-            return 0, 0
+    def _copy_year(self, conn, cur, year: int, payload: bytes) -> int:
+        buffer = io.BytesIO(payload)
         
-        t0 = time.time()
-        cur = conn.cursor()
+        # Caminho rápido: cada linha escrita uma vez só; em autocommit o
+        # COPY é atômico sozinho. Num reprocessamento o ano já sai do
+        # conjunto no início, sem mandar o payload duas vezes por batch.
+        if year in self._direct_years:
+            try:
+                cur.copy_expert(COPY_DIRECT_SQL.format(target=f"stg_evo.entries_raw_{year}"), buffer)
+                return cur.rowcount
+            except (psycopg2.IntegrityError, psycopg2.errors.UndefinedTable):
+                # Chave repetida entre batches (ou partição removida): o ano
+                # segue pelo upsert até o fim do run
+                with self.metrics_lock:
+                    self._direct_years.discard(year)
+            buffer.seek(0)
         
+        # Upsert via tmp_entries em transação explícita (ON COMMIT DELETE ROWS)
         try:
-            cur.execute("""
-                CREATE TEMP TABLE IF NOT EXISTS tmp_entries (
-                    entry_id BIGINT,
-                    entry_date TIMESTAMPTZ,
-                    raw_data JSONB,
-                    _source_file TEXT,
-                    run_id TEXT,
-                    ingestion_date DATE,
-                    _loaded_at TIMESTAMPTZ
-                ) ON COMMIT DROP
-            """)
-            cur.execute("TRUNCATE tmp_entries")
-            
-            buffer = self.prepare_batch_copy_data(parts_data)
-            cur.copy_from(buffer, 'tmp_entries', sep='\t',
-                         columns=('entry_id', 'entry_date', 'raw_data', '_source_file', 'run_id', 'ingestion_date', '_loaded_at'))
-            
-            cur.execute("""
-                INSERT INTO stg_evo.entries_raw (entry_id, entry_date, raw_data, _source_file, run_id, ingestion_date, _loaded_at)
-                SELECT entry_id, entry_date, raw_data, _source_file, run_id, ingestion_date, _loaded_at
-                FROM tmp_entries
-                ON CONFLICT (entry_id, entry_date) DO UPDATE SET
-                    raw_data = EXCLUDED.raw_data,
-                    _source_file = EXCLUDED._source_file,
-                    run_id = EXCLUDED.run_id
-            """)
-            
+            cur.execute("BEGIN")
+            cur.copy_expert(COPY_SQL, buffer)
+            cur.execute("EXECUTE ins_entries")
             count = cur.rowcount
-            conn.commit()
-            return count, time.time() - t0
-            
-        except Exception as e:
-            conn.rollback()
+            cur.execute("COMMIT")
+            return count
+        except Exception:
+            if not conn.closed:
+                try:
+                    cur.execute("ROLLBACK")
+                except psycopg2.Error:
+                    pass  # conexão quebrada: o erro original é o que importa
             raise
-        finally:
-            cur.close()
     
-    def process_batch(self, part_paths: List[str]) -> Tuple[List[str], int, Dict[str, float]]:
+    def process_batch(self, part_paths: List[str], read_future: Future) -> Tuple[List[str], int, Dict[str, float]]:
+        """COPY de um batch já preparado pelos readers; failover refaz só o COPY."""
         max_retries = 5
         base_delay = 30
         
+        payloads, read_timings, invalid = read_future.result()
+        
+        # Registros ignorados no processo filho: o log do run fica aqui no pai
+        for source_file, count in invalid.items():
+            logger.warning(f"{source_file}: {count} registro(s) com date inválida ignorado(s)")
+        if invalid:
+            with self.metrics_lock:
+                self.metrics['invalid_dates'] += sum(invalid.values())
+        
         for attempt in range(max_retries):
             try:
-                parts_data, read_timings = self.lake.read_multiple_parts(part_paths)
-                
                 with self.pool_manager.get_connection() as conn:
-                    count, db_time = self.load_batch_with_copy(conn, parts_data)
+                    count, db_time = self.load_batch_with_copy(conn, payloads)
                 
                 with self.metrics_lock:
                     self.metrics['total_download'] += read_timings['download']
-                    self.metrics['total_decompress'] += read_timings['decompress']
                     self.metrics['total_parse'] += read_timings['parse']
+                    self.metrics['total_prepare'] += read_timings['prepare']
                     self.metrics['total_copy'] += db_time
                 
                 return part_paths, count, {**read_timings, 'db': db_time}
                 
-            except Exception as e:
-                error_msg = str(e).lower()
-                is_failover = any(x in error_msg for x in [
-                    'read-only', 'readonly', 'connection already closed',
-                    'adminshutdown', 'server closed', 'terminating connection'
-                ])
-                
-                if is_failover and attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    logger.warning(f"⚠️ Failover detectado, aguardando {delay}s...")
-                    time.sleep(delay)
-                    continue
-                else:
+            except RETRYABLE_ERRORS:
+                if attempt == max_retries - 1:
                     raise
+                delay = base_delay * (2 ** attempt)
+                logger.warning(f"⚠️ Failover detectado, aguardando {delay}s...")
+                time.sleep(delay)
     
     def run(self, all_runs: bool = False, run_id: Optional[str] = None) -> Dict[str, Any]:
         logger.info("="*70)
         logger.info("EVO ENTRIES - LOADER OTIMIZADO v2 (ALTO VOLUME)")
         logger.info("="*70)
-        logger.info(f"Workers: {self.workers} | Batch size: {self.batch_size} parts")
+        logger.info(f"Workers: {self.workers} (+{self.cpu_workers} processos de parse) | Batch: ~{self.batch_bytes / 2**20:.0f} MB, até {self.batch_size} parts")
         
         if all_runs:
             run_ids = self.find_all_run_ids()
@@ -345,7 +613,7 @@ class FastEntriesLoaderV2:
         if not parts:
             return {"error": "No parts found"}
         
-        batches = [parts[i:i + self.batch_size] for i in range(0, len(parts), self.batch_size)]
+        batches = self.pack_batches(parts)
         logger.info(f"Batches: {len(batches)}")
         
         total_records = 0
@@ -353,36 +621,70 @@ class FastEntriesLoaderV2:
         errors = 0
         start_time = time.time()
         
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            futures = {executor.submit(self.process_batch, batch): batch for batch in batches}
-            
-            for future in as_completed(futures):
+        # Pipeline: readers baixam/parseiam batches à frente (fila limitada,
+        # memória sob controle) enquanto os workers fazem o COPY
+        ready = queue.Queue(maxsize=2 * self.workers)
+        done = queue.Queue()
+        
+        # Datas sem offset são montadas no TimeZone da sessão (igual em todo o pool)
+        with self.pool_manager.get_connection() as conn:
+            tz = self.pool_manager.session_tz(conn)
+            self._direct_years = self.find_direct_years(conn)
+        logger.info(f"COPY direto (partições vazias): {sorted(self._direct_years) or 'nenhuma'}")
+        
+        def feed():
+            for batch in batches:
+                ready.put((batch, readers.submit(self.read_batch, batch, cpu, tz)))
+            for _ in range(self.workers):
+                ready.put(None)
+        
+        def consume():
+            while (item := ready.get()) is not None:
                 try:
-                    paths, count, timings = future.result()
-                    total_records += count
-                    processed_batches += 1
-                    
-                    if processed_batches % 50 == 0 or processed_batches == len(batches):
-                        elapsed = time.time() - start_time
-                        rate = total_records / elapsed if elapsed > 0 else 0
-                        logger.info(f"  [{processed_batches}/{len(batches)}] {total_records:,} ({rate:,.0f}/s)")
-                        
+                    done.put((self.process_batch(*item), None))
                 except Exception as e:
+                    done.put((None, e))
+        
+        with ProcessPoolExecutor(max_workers=self.cpu_workers) as cpu, \
+                ThreadPoolExecutor(max_workers=self.workers) as readers, \
+                ThreadPoolExecutor(max_workers=self.workers + 1) as pipeline:
+            pipeline.submit(feed)
+            for _ in range(self.workers):
+                pipeline.submit(consume)
+            
+            for _ in batches:
+                result, error = done.get()
+                if error is not None:
                     errors += 1
-                    logger.error(f"Erro: {e}")
+                    logger.error(f"Erro: {error}")
+                    continue
+                
+                paths, count, timings = result
+                total_records += count
+                processed_batches += 1
+                
+                if processed_batches % 50 == 0 or processed_batches == len(batches):
+                    elapsed = time.time() - start_time
+                    rate = total_records / elapsed if elapsed > 0 else 0
+                    logger.info(f"  [{processed_batches}/{len(batches)}] {total_records:,} ({rate:,.0f}/s)")
         
         total_elapsed = time.time() - start_time
         self.pool_manager.close_all()
+        self.lake.close()
         
         logger.info("="*70)
         logger.info("MÉTRICAS DE TEMPO")
         logger.info("="*70)
         for k, v in self.metrics.items():
+            if not k.startswith('total_'):
+                continue
             pct = v / total_elapsed * 100 if total_elapsed > 0 else 0
             logger.info(f"  {k}: {v:.1f}s ({pct:.1f}%)")
         
         logger.info("="*70)
         logger.info(f"Total: {total_records:,} em {total_elapsed:.1f}s ({total_records/total_elapsed:,.0f}/s)")
+        if self.metrics['invalid_dates']:
+            logger.warning(f"Registros ignorados (date inválida): {self.metrics['invalid_dates']:,}")
         
         return {
             "run_id": "ALL" if all_runs else run_id,
@@ -396,14 +698,20 @@ class FastEntriesLoaderV2:
 
 
 def main():
+    setup_logging()
     parser = argparse.ArgumentParser(description="Loader otimizado v2 para EVO Entries")
     parser.add_argument("--run-id", help="Run ID específico")
     parser.add_argument("--all-runs", action="store_true", help="Processa TODOS os run_ids")
     parser.add_argument("--workers", type=int, default=8, help="Workers paralelos")
-    parser.add_argument("--batch-size", type=int, default=10, help="Parts por batch")
+    parser.add_argument("--batch-size", type=int, default=BATCH_MAX_PARTS, help="Máximo de parts por batch")
+    parser.add_argument("--batch-bytes", type=int, default=BATCH_BYTES, help="Bytes comprimidos por batch")
+    parser.add_argument("--cpu-workers", type=int, default=None, help="Processos de parse (padrão: nº de CPUs)")
+    parser.add_argument("--refresh-index", action="store_true", help="Descarta o índice de paths em .cache/ e relista o lake")
     args = parser.parse_args()
     
-    loader = FastEntriesLoaderV2(workers=args.workers, batch_size=args.batch_size)
+    loader = FastEntriesLoaderV2(workers=args.workers, batch_size=args.batch_size,
+                                 batch_bytes=args.batch_bytes, cpu_workers=args.cpu_workers,
+                                 refresh_index=args.refresh_index)
     result = loader.run(all_runs=args.all_runs, run_id=args.run_id)
     print(json.dumps(result, indent=2, default=str))
 
@@ -4,14 +4,14 @@ Loader OTIMIZADO v2: EVO Members Bronze → STG
 
 OTIMIZAÇÕES:
 1. ThreadedConnectionPool - reutiliza conexões
-2. Batch de múltiplos parts em um único COPY
+2. Batch de múltiplos parts em um único COPY (~20k linhas)
 3. Streaming decompress
 4. Log detalhado por fase
 5. Retry resiliente para failover Azure
 
 Uso:
     cd C:/skyfit-datalake/evo_members
-    python src/loaders/load_evo_members_stg_fast_v2.py --workers 8 --batch-size 10 --all-runs
+    python src/loaders/load_evo_members_stg_fast_v2.py --workers 8 --batch-rows 20000 --all-runs
 """
 import argparse
 import gzip
@@ -20,18 +20,32 @@ import json
 import logging
 import os
 import re
+import struct
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from datetime import datetime, timezone
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
 from pathlib import Path
-from threading import Lock
+from threading import Lock, local
 from typing import Any, Dict, List, Optional, Tuple
+from weakref import WeakSet
 
 import psycopg2
 from psycopg2 import pool
 
+try:
+    import orjson
+except ImportError:  # fallback: json da stdlib
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:  # fallback: parse completo do registro (orjson/json)
+    simdjson = None
+
 SCRIPT_DIR = Path(__file__).parent.resolve()
 PROJECT_ROOT = SCRIPT_DIR.parent.parent
 LOG_DIR = PROJECT_ROOT / "logs"
@@ -39,6 +53,78 @@ LOG_DIR.mkdir(exist_ok=True)
 
 logging.getLogger("azure").setLevel(logging.WARNING)
 
+# Batches por linhas (COPY + upsert amortizados), com teto de parts por batch
+BATCH_ROWS = 20000
+BATCH_MAX_PARTS = 50
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+# Failover do PostgreSQL: conexão caiu/recusada ou servidor virou read-only.
+# Outros erros (dados, SQL, bugs) falham na hora, sem retry.
+RETRYABLE_ERRORS = (
+    psycopg2.OperationalError,  # inclui AdminShutdown e CannotConnectNow
+    psycopg2.InterfaceError,    # connection already closed
+    psycopg2.errors.ReadOnlySqlTransaction,
+)
+
+if simdjson is not None:
+    _parsers = local()
+    
+    def member_id_of(line: bytes):
+        """idMember da linha: valida o JSON sem materializar o registro (um parser por thread)."""
+        parser = getattr(_parsers, "parser", None)
+        if parser is None:
+            parser = _parsers.parser = simdjson.Parser()
+        # O documento morre na expressão: o parser só pode ser reusado sem referências vivas
+        return parser.parse(line).get("idMember")
+else:
+    def member_id_of(line: bytes):
+        """idMember da linha (parse completo)."""
+        return json_loads(line).get("idMember")
+
+
+# COPY binário (FORMAT BINARY): o JSON original do bronze vai direto para o
+# jsonb, sem reserializar nem escapar no cliente
+COPY_COLUMNS = ('member_id', 'raw_data', '_source_file', 'run_id', 'ingestion_date', '_loaded_at', '_updated_at')
+# TRUNCATE + COPY numa única chamada (transação implícita: se o COPY falha, o TRUNCATE volta)
+COPY_SQL = f"TRUNCATE tmp_members; COPY tmp_members ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+# Carga inicial (members ainda não existem): COPY direto, cada linha escrita uma vez
+COPY_DIRECT_SQL = f"COPY stg_evo.members_raw ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+PG_EPOCH_DATE = PG_EPOCH.date()
+
+_ROW_PREFIX = struct.Struct(">hiqib")  # nº de campos, member_id, tamanho + versão do jsonb (1)
+_LEN = struct.Struct(">i")
+_ROW_TAIL = struct.Struct(">iiiqiq")  # ingestion_date, _loaded_at, _updated_at
+_ONE_US = timedelta(microseconds=1)
+
+
+def pg_timestamp_us(dt: datetime) -> int:
+    """Microssegundos desde 2000-01-01 UTC (TIMESTAMPTZ binário)."""
+    return (dt - PG_EPOCH) // _ONE_US
+
+
+def _row_suffix(source: bytes, run_id: bytes, ing_date_days: int, loaded_at_us: int) -> bytes:
+    """Campos finais da linha do COPY binário, constantes por part."""
+    return (_LEN.pack(len(source)) + source + _LEN.pack(len(run_id)) + run_id
+            + _ROW_TAIL.pack(4, ing_date_days, 8, loaded_at_us, 8, loaded_at_us))
+
+
+def iter_gzip_jsonl(compressed: bytes):
+    """
+    Descompacta e parseia o JSONL em streaming, linha a linha (bytes, sem decode).
+    
+    Produz (linha, idMember): a linha original vai direto para raw_data e
+    do registro só se extrai a chave.
+    """
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as gz:
+        for line in gz:
+            line = line.rstrip(b"\r\n")
+            if line.strip():
+                yield line, member_id_of(line)
+
 
 def load_env():
     env_paths = [
@@ -101,6 +187,32 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Preparados uma vez por conexão do pool (ver ConnectionPoolManager.get_connection)
+TMP_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS tmp_members (
+        member_id BIGINT,
+        raw_data JSONB,
+        _source_file TEXT,
+        run_id TEXT,
+        ingestion_date DATE,
+        _loaded_at TIMESTAMPTZ,
+        _updated_at TIMESTAMPTZ
+    )
+"""
+PREPARE_INSERT_SQL = """
+    PREPARE ins_members AS
+    INSERT INTO stg_evo.members_raw (member_id, raw_data, _source_file, run_id, ingestion_date, _loaded_at, _updated_at)
+    SELECT member_id, raw_data, _source_file, run_id, ingestion_date, _loaded_at, _updated_at
+    FROM tmp_members
+    ON CONFLICT (member_id) DO UPDATE SET
+        raw_data = EXCLUDED.raw_data,
+        _source_file = EXCLUDED._source_file,
+        run_id = EXCLUDED.run_id,
+        ingestion_date = EXCLUDED.ingestion_date,
+        _updated_at = EXCLUDED._updated_at
+"""
+
+
 class ConnectionPoolManager:
     _instance = None
     _lock = Lock()
@@ -111,6 +223,7 @@ class ConnectionPoolManager:
                 cls._instance = super().__new__(cls)
                 cls._instance._pool = None
                 cls._instance._initialized = False
+                cls._instance._prepared = WeakSet()
             return cls._instance
     
     def initialize(self, min_conn: int = 2, max_conn: int = 10):
@@ -126,10 +239,31 @@ class ConnectionPoolManager:
     @contextmanager
     def get_connection(self):
         conn = self._pool.getconn()
+        discard = False
         try:
+            if conn not in self._prepared:
+                self._setup_session(conn)
             yield conn
+        except RETRYABLE_ERRORS:
+            # Após failover a conexão pode seguir viva no servidor antigo (read-only)
+            discard = True
+            raise
         finally:
-            self._pool.putconn(conn)
+            self._pool.putconn(conn, close=discard)
+    
+    def _setup_session(self, conn):
+        """
+        Temp table e INSERT preparado ficam na sessão; depois a conexão passa
+        a autocommit (o batch vira dois round-trips: TRUNCATE+COPY e EXECUTE).
+        """
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            cur.execute(TMP_TABLE_SQL)
+            cur.execute("DEALLOCATE ALL")  # setup repetido após falha parcial
+            cur.execute(PREPARE_INSERT_SQL)
+        conn.commit()
+        conn.autocommit = True
+        self._prepared.add(conn)
     
     def close_all(self):
         if self._pool:
@@ -138,7 +272,7 @@ class ConnectionPoolManager:
 
 
 class OptimizedLakeClient:
-    def __init__(self):
+    def __init__(self, download_workers: int = 4):
         from azure.storage.filedatalake import DataLakeServiceClient
         self.service = DataLakeServiceClient(
             account_url=f"https://{ENV['AZURE_STORAGE_ACCOUNT_NAME']}.dfs.core.windows.net",
@@ -146,6 +280,15 @@ class OptimizedLakeClient:
         )
         self.fs = self.service.get_file_system_client(ENV["AZURE_CONTAINER_NAME"])
         self._path_cache = {}
+        # Downloads em paralelo: rede de um part sobrepõe o parse do anterior
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers)
+    
+    def download(self, path: str) -> bytes:
+        file_client = self.fs.get_file_client(path)
+        return file_client.download_file().readall()
+    
+    def close(self):
+        self._downloads.shutdown(wait=False)
     
     def list_paths(self, prefix: str) -> List[str]:
         if prefix not in self._path_cache:
@@ -156,41 +299,47 @@ class OptimizedLakeClient:
             self._path_cache[prefix] = sorted(paths)
         return self._path_cache[prefix]
     
-    def read_multiple_parts(self, paths: List[str]) -> Tuple[List[Tuple[str, List[Dict]]], Dict[str, float]]:
-        all_records = []
-        total_timings = {'download': 0, 'decompress': 0, 'parse': 0}
-        
-        for path in paths:
-            t0 = time.time()
-            file_client = self.fs.get_file_client(path)
-            compressed = file_client.download_file().readall()
-            total_timings['download'] += time.time() - t0
-            
-            t0 = time.time()
-            decompressed = gzip.decompress(compressed)
-            total_timings['decompress'] += time.time() - t0
-            
-            t0 = time.time()
-            lines = decompressed.decode('utf-8').strip().split('\n')
-            records = [json.loads(line) for line in lines if line.strip()]
-            total_timings['parse'] += time.time() - t0
-            
-            all_records.append((path, records))
+    def read_part(self, path: str) -> Tuple[List[Tuple[bytes, Any]], Dict[str, float]]:
+        """Download + descompressão/parse de um part (roda no pool de downloads)."""
+        t0 = time.time()
+        compressed = self.download(path)
+        t1 = time.time()
+        records = list(iter_gzip_jsonl(compressed))
+        return records, {'download': t1 - t0, 'parse': time.time() - t1}
+    
+    def iter_parts(self, paths: List[str], prefetch: int):
+        """
+        Parts na ordem dos paths, com até prefetch leituras adiantadas: a rede
+        dos próximos parts sobrepõe o COPY dos anteriores sem estourar memória.
         
-        return all_records, total_timings
+        Produz (path, future de read_part).
+        """
+        pending = deque()
+        paths = iter(paths)
+        for path in islice(paths, prefetch):
+            pending.append((path, self._downloads.submit(self.read_part, path)))
+        while pending:
+            path, future = pending.popleft()
+            for next_path in islice(paths, 1):
+                pending.append((next_path, self._downloads.submit(self.read_part, next_path)))
+            yield path, future
 
 
 class FastMembersLoaderV2:
-    def __init__(self, workers: int = 4, batch_size: int = 5):
-        self.lake = OptimizedLakeClient()
+    def __init__(self, workers: int = 4, batch_size: int = BATCH_MAX_PARTS, batch_rows: int = BATCH_ROWS):
+        self.lake = OptimizedLakeClient(download_workers=workers)
         self.workers = workers
         self.batch_size = batch_size
+        self.batch_rows = batch_rows
         self.base_path = "bronze/evo/entity=members"
+        # COPY direto só na carga inicial: decidido em run() antes do pool de
+        # workers (tabela vazia) e desligado no primeiro conflito
+        self._direct_copy = False
         
         self.pool_manager = ConnectionPoolManager()
         self.pool_manager.initialize(min_conn=2, max_conn=workers + 2)
         
-        self.metrics = {'total_download': 0, 'total_decompress': 0, 'total_parse': 0, 'total_copy': 0}
+        self.metrics = {'total_download': 0, 'total_parse': 0, 'total_copy': 0}
         self.metrics_lock = Lock()
     
     def find_all_run_ids(self) -> List[str]:
@@ -212,111 +361,81 @@ class FastMembersLoaderV2:
         ing_date = date_match.group(1) if date_match else datetime.now().strftime("%Y-%m-%d")
         return run_id, ing_date
     
-    def prepare_batch_copy_data(self, parts_data: List[Tuple[str, List[Dict]]]) -> io.StringIO:
-        buffer = io.StringIO()
-        now = datetime.now(timezone.utc).isoformat()
+    def prepare_batch_copy_data(self, parts_data: List[Tuple[str, List[Tuple[bytes, Any]]]]) -> io.BytesIO:
+        """COPY binário do batch; raw_data = linha original do bronze (JSON válido)."""
+        now_us = pg_timestamp_us(datetime.now(timezone.utc))
+        # Um member por batch, última ocorrência vence: o ON CONFLICT DO UPDATE
+        # não aceita a mesma chave duas vezes (batches juntam parts de vários runs)
+        rows = {}
         
         for source_file, records in parts_data:
             run_id, ing_date = self.extract_metadata(source_file)
+            ing_days = (date.fromisoformat(ing_date) - PG_EPOCH_DATE).days
+            suffix = _row_suffix(source_file.encode(), run_id.encode(), ing_days, now_us)
             
-            for rec in records:
-                member_id = rec.get("idMember")
+            for line, member_id in records:
                 if member_id is None:
                     continue
-                
-                raw_json = json.dumps(rec, ensure_ascii=False, default=str)
-                raw_json = raw_json.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
-                
-                buffer.write(f"{member_id}\t{raw_json}\t{source_file}\t{run_id}\t{ing_date}\t{now}\n")
+                rows[int(member_id)] = (line, suffix)
         
-        buffer.seek(0)
-        return buffer
+        pack = _ROW_PREFIX.pack
+        chunks = [COPY_HEADER]
+        for member_id, (line, suffix) in rows.items():
+            chunks += (pack(7, 8, member_id, len(line) + 1, 1), line, suffix)
+        chunks.append(COPY_TRAILER)
+        return io.BytesIO(b"".join(chunks))
     
-    def load_batch_with_copy(self, conn, parts_data: List[Tuple[str, List[Dict]]]) -> Tuple[int, float]:
+    def load_batch_with_copy(self, conn, parts_data: List[Tuple[str, List[Tuple[bytes, Any]]]]) -> Tuple[int, float]:
         if not parts_data:
             return 0, 0
         
         t0 = time.time()
-        cur = conn.cursor()
+        buffer = self.prepare_batch_copy_data(parts_data)
         
-        try:
-            cur.execute("""
-                CREATE TEMP TABLE IF NOT EXISTS tmp_members (
-                    member_id BIGINT,
-                    raw_data JSONB,
-                    _source_file TEXT,
-                    run_id TEXT,
-                    ingestion_date DATE,
-                    _loaded_at TIMESTAMPTZ
-                ) ON COMMIT DROP
-            """)
-            cur.execute("TRUNCATE tmp_members")
-            
-            buffer = self.prepare_batch_copy_data(parts_data)
-            cur.copy_from(buffer, 'tmp_members', sep='\t',
-                         columns=('member_id', 'raw_data', '_source_file', 'run_id', 'ingestion_date', '_loaded_at'))
-            
-            cur.execute("""
-                INSERT INTO stg_evo.members_raw (member_id, raw_data, _source_file, run_id, ingestion_date, _loaded_at, _updated_at)
-                SELECT member_id, raw_data, _source_file, run_id, ingestion_date, _loaded_at, _loaded_at
-                FROM tmp_members
-                ON CONFLICT (member_id) DO UPDATE SET
-                    raw_data = EXCLUDED.raw_data,
-                    _source_file = EXCLUDED._source_file,
-                    run_id = EXCLUDED.run_id,
-                    ingestion_date = EXCLUDED.ingestion_date,
-                    _updated_at = EXCLUDED._loaded_at
-            """)
-            
-            count = cur.rowcount
-            conn.commit()
-            return count, time.time() - t0
+        # Autocommit: o upsert é um único statement (atômico); sobra na temp
+        # table após falha é limpa pelo TRUNCATE do próximo batch
+        with conn.cursor() as cur:
+            if self._direct_copy:
+                try:
+                    cur.copy_expert(COPY_DIRECT_SQL, buffer)
+                    return cur.rowcount, time.time() - t0
+                except psycopg2.errors.UniqueViolation:
+                    # Member repetido entre batches: daqui em diante só upsert via temp table
+                    with self.metrics_lock:
+                        self._direct_copy = False
+                    buffer.seek(0)
             
-        except Exception as e:
-            conn.rollback()
-            raise
-        finally:
-            cur.close()
+            cur.copy_expert(COPY_SQL, buffer)
+            cur.execute("EXECUTE ins_members")
+            return cur.rowcount, time.time() - t0
     
-    def process_batch(self, part_paths: List[str]) -> Tuple[List[str], int, Dict[str, float]]:
+    def process_batch(self, parts_data: List[Tuple[str, List[Tuple[bytes, Any]]]]) -> Tuple[int, float]:
+        """COPY + upsert do batch já lido, com retry em failover (sem reler o lake)."""
         max_retries = 5
         base_delay = 30
         
         for attempt in range(max_retries):
             try:
-                parts_data, read_timings = self.lake.read_multiple_parts(part_paths)
-                
                 with self.pool_manager.get_connection() as conn:
                     count, db_time = self.load_batch_with_copy(conn, parts_data)
                 
                 with self.metrics_lock:
-                    self.metrics['total_download'] += read_timings['download']
-                    self.metrics['total_decompress'] += read_timings['decompress']
-                    self.metrics['total_parse'] += read_timings['parse']
                     self.metrics['total_copy'] += db_time
                 
-                return part_paths, count, {**read_timings, 'db': db_time}
+                return count, db_time
                 
-            except Exception as e:
-                error_msg = str(e).lower()
-                is_failover = any(x in error_msg for x in [
-                    'read-only', 'readonly', 'connection already closed',
-                    'adminshutdown', 'server closed', 'terminating connection'
-                ])
-                
-                if is_failover and attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    logger.warning(f"⚠️ Failover detectado, aguardando {delay}s...")
-                    time.sleep(delay)
-                    continue
-                else:
+            except RETRYABLE_ERRORS:
+                if attempt == max_retries - 1:
                     raise
+                delay = base_delay * (2 ** attempt)
+                logger.warning(f"⚠️ Failover detectado, aguardando {delay}s...")
+                time.sleep(delay)
     
     def run(self, all_runs: bool = False, run_id: Optional[str] = None) -> Dict[str, Any]:
         logger.info("="*70)
         logger.info("EVO MEMBERS - LOADER OTIMIZADO v2")
         logger.info("="*70)
-        logger.info(f"Workers: {self.workers} | Batch size: {self.batch_size} parts")
+        logger.info(f"Workers: {self.workers} | Batch: ~{self.batch_rows:,} linhas, até {self.batch_size} parts")
         
         if all_runs:
             run_ids = self.find_all_run_ids()
@@ -334,35 +453,73 @@ class FastMembersLoaderV2:
         if not parts:
             return {"error": "No parts found"}
         
-        batches = [parts[i:i + self.batch_size] for i in range(0, len(parts), self.batch_size)]
-        logger.info(f"Batches: {len(batches)}")
+        # Tabela vazia (carga inicial): COPY direto, cada linha escrita uma vez
+        with self.pool_manager.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT NOT EXISTS (SELECT 1 FROM stg_evo.members_raw)")
+            self._direct_copy = cur.fetchone()[0]
+        logger.info(f"Modo: {'COPY direto (tabela vazia)' if self._direct_copy else 'upsert'}")
         
         total_records = 0
         processed_batches = 0
         errors = 0
         start_time = time.time()
         
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            futures = {executor.submit(self.process_batch, batch): batch for batch in batches}
-            
-            for future in as_completed(futures):
+        def collect(done):
+            nonlocal total_records, processed_batches, errors
+            for future in done:
                 try:
-                    paths, count, timings = future.result()
+                    count, _ = future.result()
                     total_records += count
                     processed_batches += 1
                     
-                    if processed_batches % 10 == 0 or processed_batches == len(batches):
+                    if processed_batches % 10 == 0:
                         elapsed = time.time() - start_time
                         rate = total_records / elapsed if elapsed > 0 else 0
-                        logger.info(f"  [{processed_batches}/{len(batches)}] {total_records:,} ({rate:,.0f}/s)")
+                        logger.info(f"  [{processed_batches} batches] {total_records:,} ({rate:,.0f}/s)")
                         
                 except Exception as e:
                     errors += 1
                     logger.error(f"Erro: {e}")
         
+        # Parts lidos em ordem (com prefetch) e acumulados até batch_rows linhas;
+        # cada batch cheio vai para um worker (um COPY por conexão do pool)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = set()
+            batch, batch_rows = [], 0
+            
+            for path, read_future in self.lake.iter_parts(parts, prefetch=2 * self.workers):
+                try:
+                    records, timings = read_future.result()
+                except Exception as e:
+                    errors += 1
+                    logger.error(f"Erro lendo {Path(path).name}: {e}")
+                    continue
+                
+                with self.metrics_lock:
+                    self.metrics['total_download'] += timings['download']
+                    self.metrics['total_parse'] += timings['parse']
+                
+                batch.append((path, records))
+                batch_rows += len(records)
+                if batch_rows < self.batch_rows and len(batch) < self.batch_size:
+                    continue
+                
+                # Backpressure: no máximo 2 batches por worker em memória
+                if len(futures) >= 2 * self.workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+                futures.add(executor.submit(self.process_batch, batch))
+                batch, batch_rows = [], 0
+            
+            if batch:
+                futures.add(executor.submit(self.process_batch, batch))
+            collect(wait(futures).done)
+        
         total_elapsed = time.time() - start_time
         self.pool_manager.close_all()
+        self.lake.close()
         
+        logger.info(f"  [{processed_batches} batches] {total_records:,} carregados")
         logger.info("="*70)
         logger.info("MÉTRICAS DE TEMPO")
         logger.info("="*70)
@@ -382,16 +539,16 @@ class FastMembersLoaderV2:
             "metrics": self.metrics,
         }
 
-
 def main():
     parser = argparse.ArgumentParser(description="Loader otimizado v2 para EVO Members")
     parser.add_argument("--run-id", help="Run ID específico")
     parser.add_argument("--all-runs", action="store_true", help="Processa TODOS os run_ids")
     parser.add_argument("--workers", type=int, default=4, help="Workers paralelos")
-    parser.add_argument("--batch-size", type=int, default=5, help="Parts por batch")
+    parser.add_argument("--batch-size", type=int, default=BATCH_MAX_PARTS, help="Máximo de parts por batch")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="Linhas por batch (COPY)")
     args = parser.parse_args()
     
-    loader = FastMembersLoaderV2(workers=args.workers, batch_size=args.batch_size)
+    loader = FastMembersLoaderV2(workers=args.workers, batch_size=args.batch_size, batch_rows=args.batch_rows)
     result = loader.run(all_runs=args.all_runs, run_id=args.run_id)
     print(json.dumps(result, indent=2, default=str))
 
@@ -316,6 +316,7 @@ def main():
 
     rid = run_manifest["reports"][0]["run_id"] if run_manifest["reports"] else str(uuid.uuid4())
     lake.write_text(f"_meta/pipedrive/runs/run_id={rid}/manifest.json", json_dumps(run_manifest), overwrite=True)
+    lake.write_text("_meta/pipedrive/latest_run_id.txt", rid, overwrite=True)
 
     print(json.dumps(run_manifest, indent=2, ensure_ascii=False))
 
@@ -9,6 +9,7 @@ Outputs:
   bronze/zendesk/scope=<scope>/entity=<entity>/ingestion_date=YYYY-MM-DD/run_id=<run_id>/part-xxxxx.jsonl.gz
   _meta/zendesk/watermarks/scope=<scope>/entity=<entity>.json
   _meta/zendesk/runs/run_id=<run_id>/manifest.json
+  _meta/zendesk/latest_run_id.txt
 """
 from __future__ import annotations
 
@@ -406,6 +407,7 @@ def main() -> None:
 
     report["run_finished_at_utc"] = utc_now_iso()
     lake.upload_bytes(runs_manifest_path(rid), json.dumps(report, ensure_ascii=False).encode("utf-8"), content_type="application/json")
+    lake.upload_bytes("_meta/zendesk/latest_run_id.txt", rid.encode("utf-8"), content_type="text/plain")
     print(json.dumps(report, ensure_ascii=False, indent=2))
 
 
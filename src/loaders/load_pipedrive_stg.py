@@ -77,24 +77,7 @@ class PipedriveStgLoader:
     
     def find_latest_run_id(self) -> Optional[str]:
         """Encontra o run_id mais recente para Pipedrive."""
-        prefix = "_meta/pipedrive/runs/"
-        manifests = []
-        
-        for blob_name in self.lake.list_blobs(prefix):
-            if blob_name.endswith("/manifest.json"):
-                parts = blob_name.split("/")
-                for part in parts:
-                    if part.startswith("run_id="):
-                        run_id = part.replace("run_id=", "")
-                        manifests.append((run_id, blob_name))
-                        break
-        
-        if not manifests:
-            return None
-        
-        # Ordena por run_id (formato timestamp)
-        manifests.sort(key=lambda x: x[0], reverse=True)
-        return manifests[0][0]
+        return self.lake.get_latest_run_id("pipedrive")
     
     def get_manifest(self, run_id: str) -> Optional[Dict[str, Any]]:
         """Obtém o manifest de um run."""
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Testes do DatabaseClient com psycopg2 fake (sem PostgreSQL).
+
+Uso: python -m pytest -q tests
+"""
+import sys
+from pathlib import Path
+
+import psycopg2
+import psycopg2.pool
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from src.common.db import DatabaseClient  # noqa: E402
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+
+    def cursor(self):
+        return object()
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, **params):
+        self.closed = False
+        self.conns = []
+
+    def getconn(self):
+        conn = FakeConnection()
+        self.conns.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def closeall(self):
+        self.closed = True
+
+
+def make_client(monkeypatch) -> DatabaseClient:
+    monkeypatch.setattr(psycopg2, "connect", lambda **params: FakeConnection())
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    return DatabaseClient(host="h", port=5432, database="d", user="u", password="p")
+
+
+def test_connect_returns_a_connection(monkeypatch):
+    db = make_client(monkeypatch)
+    conn = db.connect()
+    assert isinstance(conn, FakeConnection)
+    conn.cursor()
+    assert db.connect() is conn  # reutilizada até fechar
+
+
+def test_pool_is_separate_from_connect(monkeypatch):
+    db = make_client(monkeypatch)
+    conn = db.connect()
+    pool = db.pool()
+    assert isinstance(pool, FakePool)
+    with db.connection() as pooled:
+        assert pooled is not conn
+    db.close()
+    assert conn.closed and pool.closed
+
+
+def test_bulk_insert_jsonb_copies_only_on_opt_in(monkeypatch):
+    import psycopg2.extras
+    from contextlib import contextmanager
+
+    db = make_client(monkeypatch)
+    calls = []
+    monkeypatch.setattr(db, "COPY_THRESHOLD", 2)
+    monkeypatch.setattr(db, "copy_jsonb", lambda *a, **k: calls.append("copy") or 3)
+    monkeypatch.setattr(psycopg2.extras, "execute_values",
+                        lambda cur, sql, rows, **k: calls.append("insert") or list(rows))
+
+    @contextmanager
+    def cursor(commit=True):
+        yield object()
+
+    monkeypatch.setattr(db, "cursor", cursor)
+    records = [{"id": i} for i in range(3)]
+
+    assert db.bulk_insert_jsonb("s", "t", records) == 3
+    assert calls == ["insert"]
+    assert db.bulk_insert_jsonb("s", "t", records, use_copy=True) == 3
+    assert calls == ["insert", "copy"]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Testes da allowlist de campos (--fields) do extrator de EVO Members.
+
+Uso: python -m pytest -q tests
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src" / "evo" / "extractors"))
+
+from evo_members_bronze_parallel import field_allowlist, prune  # noqa: E402
+
+
+def test_field_allowlist_without_fields_keeps_full_record():
+    assert field_allowlist(None) is None
+    assert field_allowlist("") is None
+
+
+def test_prune_keeps_member_key_outside_fields():
+    keep = field_allowlist("nome, email")
+    record = {"idMember": 42, "nome": "Ana", "email": "a@x.com", "memberships": [{"id": 1}]}
+    assert prune(record, keep) == {"idMember": 42, "nome": "Ana", "email": "a@x.com"}
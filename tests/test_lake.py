@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Testes do LakeClient com um downloader fake (sem rede/Azure).
+
+Uso: python -m pytest -q tests
+"""
+import gzip
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from src.common.lake import LakeClient  # noqa: E402
+
+
+class FakeDownloader:
+    """Imita o StorageStreamDownloader: readall/chunks/readinto(stream)."""
+
+    def __init__(self, data: bytes, chunk_size: int = 7):
+        self.data = data
+        self.size = len(data)
+        self.chunk_size = chunk_size
+
+    def readall(self) -> bytes:
+        return self.data
+
+    def chunks(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i:i + self.chunk_size]
+
+    def readinto(self, stream) -> int:
+        # Como o SDK: o destino precisa ser um stream (seekable/write)
+        stream.seekable()
+        stream.write(self.data)
+        return self.size
+
+
+class FakeBlobClient:
+    def __init__(self, blobs: dict, path: str, chunk_size: int):
+        self.blobs = blobs
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def download_blob(self, **kwargs):
+        if self.path not in self.blobs:
+            raise FileNotFoundError(self.path)
+        return FakeDownloader(self.blobs[self.path], self.chunk_size)
+
+
+def make_lake(blobs: dict, chunk_size: int = 7) -> LakeClient:
+    lake = LakeClient(account="x", key="x", container="x")
+    lake.blob_client = lambda path: FakeBlobClient(blobs, path, chunk_size)
+    return lake
+
+
+def test_read_text_round_trip():
+    text = "run_id=20240501T000000Z — ação\n"
+    lake = make_lake({"a.txt": text.encode("utf-8")})
+    assert lake.read_text("a.txt") == text
+
+
+def test_read_json_round_trip():
+    obj = {"run_id": "r1", "entities": ["deals", "persons"], "n": 3}
+    lake = make_lake({"_meta/x/manifest.json": json.dumps(obj).encode("utf-8")})
+    assert lake.read_json("_meta/x/manifest.json") == obj
+
+
+def test_read_text_missing_blob_returns_none():
+    lake = make_lake({})
+    assert lake.read_text("nao/existe.txt") is None
+    assert lake.read_json("nao/existe.json") is None
+
+
+def _jsonl_gz(records) -> bytes:
+    return gzip.compress(b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in records))
+
+
+def test_iter_jsonl_gz_reads_every_gzip_member():
+    # Três membros concatenados (como os appends dos extratores EVO); o
+    # último sem "\n" final
+    first = [{"id": i} for i in range(5)]
+    second = [{"id": i} for i in range(5, 9)]
+    data = _jsonl_gz(first) + _jsonl_gz(second) + gzip.compress(b'{"id": 9}')
+    for chunk_size in (1, 7, len(data)):
+        lake = make_lake({"p.jsonl.gz": data}, chunk_size)
+        assert [r["id"] for r in lake.iter_jsonl_gz("p.jsonl.gz")] == list(range(10))
+
+
+def test_latest_run_id_uses_pointer_only_where_published():
+    blobs = {
+        "_meta/pipedrive/latest_run_id.txt": b"20240502T000000Z\n",
+        "_meta/evo/latest_run_id.txt": b"stale",
+    }
+    runs = ["20240501T000000Z", "20240503T000000Z"]
+    lake = make_lake(blobs)
+    lake.list_prefixes = lambda prefix: iter(f"{prefix}run_id={r}/" for r in runs)
+    assert lake.get_latest_run_id("pipedrive") == "20240502T000000Z"
+    assert lake.get_latest_run_id("evo") == "20240503T000000Z"